@@ -1,34 +1,59 @@
 import json
-import os
 import re
-import tempfile
-from threading import Timer
+import time
+from functools import lru_cache
+from threading import Lock
 from typing import Union
 from urllib.parse import urljoin
 
 import const
+import metrics
 import requests
+from cameras import Camera, CameraRegistry
 from logger import log
-from utils import generate_uuid
+from tokens import token_refresher
+from transport import Transport
+from utils import atomic_write_json, data_path, decode_jwt_claims, file_lock, generate_uuid
+
+
+@lru_cache(maxsize=256)
+def _endpoint_label(uri: str) -> str:
+    return re.sub(r'[0-9a-f]{32}', ':uuid', uri)
+
+
+STATE_VERSION = 3
 
 
 class AbodeApiClient:
     def __init__(self, username: str = None, password: str = None, locale: str = const.DEFAULT_LOCALE,
-                 refresh_token_in_background: bool = False) -> None:
+                 refresh_token_in_background: bool = False, login: bool = True, account: str = None) -> None:
         self._username = username
         self._password = password
         self._locale = locale
         self._do_refresh = refresh_token_in_background
-        self._session = requests.Session()
+        # Each account gets its own connection pool and circuit breaker
+        self._session = Transport(f"Abode ({account})" if account else 'Abode', pool_size=const.ABODE_POOL_SIZE)
         self._features = None
         self._devices = None
         self._cameras = None
-        self._token_timer = None
-        if self._username and self._password:
+        self._token_lock = Lock()
+        self._api_key = None
+        self._access_token = None
+        self._token_expires = 0
+        self._path = None
+        if login and self._username and self._password:
             self.login()
 
-    def _request(self, method: str, uri: str, data=None, raise_for_status=False) -> Union[dict, list]:
-        response = self._session.request(method, urljoin(const.BASE_URL, uri), data=data)
+    def _request(self, method: str, uri: str, data=None, raise_for_status=False,
+                 retry_unauthorized=True, idempotent=None) -> Union[dict, list]:
+        start = time.monotonic()
+        response = self._session.request(method, urljoin(const.BASE_URL, uri), data=data, idempotent=idempotent)
+        metrics.ABODE_REQUEST_SECONDS.observe(time.monotonic() - start, method, _endpoint_label(uri))
+        if response.status_code == 401 and retry_unauthorized:
+            log.info(f"Abode rejected our access token for {uri}, logging in again")
+            self._renew_token(rejected_token=self._access_token)
+            return self._request(method, uri, data=data, raise_for_status=raise_for_status,
+                                 retry_unauthorized=False, idempotent=idempotent)
         if raise_for_status:
             response.raise_for_status()
         return response.json()
@@ -38,38 +63,130 @@ class AbodeApiClient:
                                       'Authorization': f"Bearer {self._access_token}"})
 
     def _get_api_key(self) -> str:
+        start = time.monotonic()
         login = self._request('POST', '/api/auth2/login', data={
             'id': self._username,
             'password': self._password,
             'locale_code': self._locale,
             'uuid': generate_uuid()
-        })
+        }, raise_for_status=True, retry_unauthorized=False)
+        metrics.ABODE_LOGIN_SECONDS.observe(time.monotonic() - start)
         return login['token']
 
     def _get_access_token(self) -> str:
-        claims = self._request('GET', '/api/auth2/claims')
-        self._start_refresh_timer()
+        start = time.monotonic()
+        claims = self._request('GET', '/api/auth2/claims', raise_for_status=True, retry_unauthorized=False)
+        metrics.ABODE_CLAIMS_SECONDS.observe(time.monotonic() - start)
         return claims['access_token']
 
-    def _refresh_access_token(self) -> None:
-        log.info("Refreshing Abode access token")
-        self._access_token = self._get_access_token()
+    def _set_access_token(self, access_token: str) -> None:
+        self._access_token = access_token
+        exp = decode_jwt_claims(access_token).get('exp')
+        if isinstance(exp, (int, float)):
+            self._token_expires = exp
+        else:
+            self._token_expires = time.time() + const.TOKEN_LIFETIME
         self._set_auth_headers()
-        self._start_refresh_timer()
-        self.save()
 
-    def _start_refresh_timer(self) -> None:
-        if not self._do_refresh:
+    @property
+    def name(self) -> str:
+        return self._session.name
+
+    @property
+    def token_expires(self) -> float:
+        return self._token_expires
+
+    @property
+    def token_issued(self) -> float:
+        """
+        When the current access token was issued, or our best guess if it doesn't say.
+        """
+        iat = decode_jwt_claims(self._access_token).get('iat') if self._access_token else None
+        return iat if isinstance(iat, (int, float)) else self._token_expires - const.TOKEN_LIFETIME
+
+    def _token_is_fresh(self, margin: float = const.TOKEN_EXPIRY_MARGIN) -> bool:
+        return bool(self._access_token) and self._token_expires - time.time() > margin
+
+    def _reload_tokens(self) -> None:
+        """
+        Picks up tokens that another process may have saved to our state file while we were
+        waiting for the lock.
+        """
+        try:
+            with open(self._path, 'r') as f:
+                data = json.load(f)
+        except (IOError, ValueError):
             return
-        if self._token_timer:
-            self._token_timer.cancel()
-        self._token_timer = Timer(const.TOKEN_REFRESH_INTERVAL, self._refresh_access_token)
-        self._token_timer.start()
+        if data.get('access_token') and data.get('token_expires', 0) > self._token_expires:
+            self._api_key = data['api_key']
+            self._access_token = data['access_token']
+            self._token_expires = data['token_expires']
+            self._set_auth_headers()
+
+    def _renew_token(self, force: bool = False, rejected_token: str = None,
+                     margin: float = const.TOKEN_EXPIRY_MARGIN) -> None:
+        """
+        Gets a new access token, with a file lock around the state file so that concurrent
+        resolvers share a single refresh instead of each logging in. The new token is written to
+        the state file before the lock is released.
+        """
+        with self._token_lock, file_lock(self._lock_path()):
+            if self._path:
+                self._reload_tokens()
+            if rejected_token is not None and self._access_token != rejected_token:
+                return
+            if not force and rejected_token is None and self._token_is_fresh(margin):
+                return
+            if self._api_key and rejected_token is None:
+                try:
+                    self._set_access_token(self._get_access_token())
+                    metrics.TOKEN_REFRESH_TOTAL.inc('refresh')
+                except (requests.RequestException, KeyError, ValueError) as exc:
+                    log.info(f"Unable to refresh access token ({exc}), logging in again")
+                    self._login()
+            else:
+                self._login()
+            if self._path:
+                self.save(self._path)
+        if self._do_refresh:
+            token_refresher.reschedule(self)
+
+    def token_rejected(self) -> None:
+        """
+        Gets a new access token after something other than the REST API (the event feed, say)
+        turned the current one away.
+        """
+        self._renew_token(rejected_token=self._access_token)
+
+    def session_credentials(self) -> tuple:
+        """
+        Returns the headers and cookies that authenticate us, for connections made outside of
+        our requests session.
+        """
+        self.ensure_token()
+        return dict(self._session.headers), self._session.cookies.get_dict()
+
+    def refresh_token(self) -> None:
+        """
+        Renews the access token ahead of expiry, unless another process has just done so.
+        """
+        log.info(f"Refreshing {self._session.name} access token")
+        self._renew_token(margin=const.TOKEN_REFRESH_MARGIN + const.TOKEN_REFRESH_JITTER)
+
+    def ensure_token(self) -> None:
+        """
+        Makes sure we have an access token that isn't about to expire. Only talks to Abode if the
+        token is missing or close to expiry.
+        """
+        if not self._token_is_fresh():
+            self._renew_token()
+
+    def _start_refresh_timer(self) -> None:
+        if self._do_refresh and self._access_token:
+            token_refresher.add(self)
 
     def _cancel_refresh_timer(self) -> None:
-        if self._token_timer:
-            self._token_timer.cancel()
-            self._token_timer = None
+        token_refresher.remove(self)
 
     def __enter__(self) -> 'AbodeApiClient':
         return self
@@ -77,10 +194,16 @@ class AbodeApiClient:
     def __exit__(self, exc_type, exc_val, exc_tb) -> None:
         self._cancel_refresh_timer()
 
-    def login(self) -> None:
+    def _login(self) -> None:
+        log.info(f"Logging into {self._session.name}")
         self._api_key = self._get_api_key()
-        self._access_token = self._get_access_token()
-        self._set_auth_headers()
+        self._set_access_token(self._get_access_token())
+        metrics.TOKEN_REFRESH_TOTAL.inc('login')
+
+    def login(self) -> None:
+        with self._token_lock:
+            self._login()
+        self._start_refresh_timer()
 
     def _get_features(self) -> dict:
         if not self._features:
@@ -94,15 +217,24 @@ class AbodeApiClient:
             self._devices = self._request('GET', '/api/v1/devices')
         return self._devices
 
-    def _get_cameras(self) -> list:
-        if not self._cameras:
-            self._get_devices()
-            self._cameras = [d for d in self._devices if d['type_tag'] == const.CAMERA_TYPE and
-                             d['origin'] == 'abode_cam']
+    def _get_cameras(self) -> CameraRegistry:
+        if self._cameras is None:
+            self._cameras = CameraRegistry()
+            self._cameras.update_from_devices(self._get_devices())
             if len(self._cameras) == 0:
                 log.warning("No cameras found in your Abode setup")
         return self._cameras
 
+    def refresh_devices(self) -> CameraRegistry:
+        """
+        Fetches the device list again from Abode and updates the cameras to match.
+        """
+        self._devices = self._request('GET', '/api/v1/devices', raise_for_status=True)
+        if self._cameras is None:
+            return self._get_cameras()
+        self._cameras.update_from_devices(self._devices)
+        return self._cameras
+
     @property
     def features(self) -> dict:
         return self._get_features()
@@ -112,89 +244,99 @@ class AbodeApiClient:
         return self._get_devices()
 
     @property
-    def cameras(self) -> list:
+    def cached_devices(self) -> list:
+        """
+        The device list we already have, without asking Abode for it if we don't.
+        """
+        return self._devices or list()
+
+    @property
+    def cameras(self) -> CameraRegistry:
         return self._get_cameras()
 
-    def by_uuid(self, cam_uuid: str) -> dict:
-        results = [d for d in self.cameras if d['uuid'] == cam_uuid]
-        if len(results) == 0:
-            raise KeyError(f"Camera with UUID {cam_uuid} not found")
-        return results[0]
-
-    def by_name(self, cam_name: str) -> dict:
-        results = [d for d in self.cameras if d['name'] == cam_name]
-        if len(results) == 0:
-            raise KeyError(f"Camera with name '{cam_name}' not found")
-        return results[0]
-
-    def by_id(self, cam_id: str) -> dict:
-        results = [d for d in self.cameras if d['id'] == cam_id]
-        if len(results) == 0:
-            raise KeyError(f"Camera with id {cam_id} not found")
-        return results[0]
-
-    def camera(self, id: str) -> dict:
-        if id.startswith('XF:'):
-            return self.by_id(id)
-        elif re.fullmatch(r'[0-9a-f]{32}', id):
-            return self.by_uuid(id)
-        else:
-            return self.by_name(id)
+    def by_uuid(self, cam_uuid: str) -> Camera:
+        return self.cameras.by_uuid(cam_uuid)
+
+    def by_name(self, cam_name: str) -> Camera:
+        return self.cameras.by_name(cam_name)
+
+    def by_id(self, cam_id: str) -> Camera:
+        return self.cameras.by_id(cam_id)
+
+    def camera(self, id: str) -> Camera:
+        return self.cameras.lookup(id)
 
     def has_247_recording(self, id: str) -> bool:
-        cam = self.camera(id)
-        return cam['canStream247']
+        return self.camera(id).can_stream_247
 
     def to_json(self) -> dict:
+        # Only what a resolver needs: the password stays in the add-on options, and the full
+        # device list is reduced to one short row per camera.
         return {
+            'version': STATE_VERSION,
             'username': self._username,
-            'password': self._password,
             'api_key': self._api_key,
             'access_token': self._access_token,
-            'features': self.features,
-            'devices': self.devices,
-            'cameras': self.cameras
+            'token_expires': self._token_expires,
+            **self.cameras.to_json()
         }
 
     @classmethod
-    def from_json(cls, data) -> 'AbodeApiClient':
-        self = cls()
+    def from_json(cls, data, **kwargs) -> 'AbodeApiClient':
+        if data.get('version') != STATE_VERSION:
+            raise ValueError(f"Unsupported Abode state version {data.get('version')}")
+        kwargs.setdefault('login', False)
+        self = cls(**kwargs)
+        if self._username and self._username != data['username']:
+            raise ValueError("Saved Abode state belongs to a different user")
         self._username = data['username']
-        self._password = data['password']
         self._api_key = data['api_key']
         self._access_token = data['access_token']
-        self._features = data['features']
-        self._devices = data['devices']
-        self._cameras = data['cameras']
-        self._set_auth_headers
+        self._token_expires = data['token_expires']
+        self._cameras = CameraRegistry.from_json(data)
+        self._set_auth_headers()
+        self._start_refresh_timer()
         return self
 
     @staticmethod
     def _temp_path() -> str:
-        return os.path.join(tempfile.gettempdir(), 'abode.json')
+        return data_path('abode.json')
+
+    def _lock_path(self) -> str:
+        return (self._path or self._temp_path()) + '.lock'
 
-    def save(self, path: str = None) -> None:
-        path = path or self._temp_path()
-        with open(path, 'w') as f:
-            json.dump(self.to_json(), f)
+    def save(self, path: str = None) -> str:
+        path = path or self._path or self._temp_path()
+        atomic_write_json(path, self.to_json())
+        self._path = path
         return path
 
     @classmethod
-    def load(cls, path: str = None) -> 'AbodeApiClient':
+    def load(cls, path: str = None, **kwargs) -> 'AbodeApiClient':
+        """
+        Restores a client from saved state without logging in. Any keyword arguments (such as the
+        credentials, for when the saved token needs replacing) are passed to the constructor.
+        """
         path = path or cls._temp_path()
         with open(path, 'r') as f:
-            self = cls.from_json(json.load(f))
-            self._set_auth_headers()
-            return self
+            self = cls.from_json(json.load(f), **kwargs)
+        self._path = path
+        return self
 
     def get_kvs_stream(self, id: str) -> dict:
         cam = self.camera(id)
-        log.debug(f"Getting KVS endpoint url for camera {cam['name']}")
-        data = self._request('POST', f"/integrations/v1/camera/{cam['uuid']}/kvs/stream", raise_for_status=False)
+        self.ensure_token()
+        log.debug(f"Getting KVS endpoint url for camera {cam.name}")
+        start = time.monotonic()
+        # Asking for a stream again just gets a fresh endpoint, so this POST is safe to retry
+        data = self._request('POST', f"/integrations/v1/camera/{cam.uuid}/kvs/stream", raise_for_status=False,
+                             idempotent=True)
+        metrics.KVS_STREAM_SECONDS.observe(time.monotonic() - start)
         if 'errorCode' in data:
             if data['errorCode'] == const.ERR_CAMERA_OFFLINE:
-                log.warning(f"Camera '{cam['name']}' is offline, skipping")
+                metrics.CAMERA_OFFLINE_TOTAL.inc()
+                log.warning(f"Camera '{cam.name}' is offline, skipping")
                 return None
             else:
-                raise Exception(f"Error {data['errorCode']} ({data['message']}) getting stream for {cam['name']}")
+                raise Exception(f"Error {data['errorCode']} ({data['message']}) getting stream for {cam.name}")
         return data
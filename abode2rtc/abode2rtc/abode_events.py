@@ -0,0 +1,240 @@
+import json
+import time
+from queue import Queue
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, List, Set
+
+import websocket
+
+import const
+import metrics
+from abode import AbodeApiClient
+from cameras import Camera
+from logger import log
+
+DEVICE_UPDATE = 'com.goabode.device.update'
+
+_RECONNECTED = '__reconnected__'
+
+
+class AbodeEventSocket:
+    """
+    Abode's realtime event feed: the Socket.IO channel the Abode app listens on, spoken directly
+    over a WebSocket (Engine.IO protocol 3). Event callbacks run one at a time on a separate
+    dispatcher thread, so they can call the Abode API. If the connection drops it is
+    re-established with backoff and the reconnect callbacks are called so that listeners can
+    catch up on anything they missed; if Abode turns our access token away a new one is fetched
+    before trying again.
+    """
+    def __init__(self, client: AbodeApiClient, name: str = 'Abode') -> None:
+        self.name = name
+        self.url = const.BASE_URL.replace('http', 'ws', 1).rstrip('/') + '/socket.io/?EIO=3&transport=websocket'
+        self._client = client
+        self._ws = None
+        self._ping_interval = const.ABODE_EVENTS_PING_INTERVAL
+        self._ping_timeout = const.ABODE_EVENTS_TIMEOUT
+        self._handlers: Dict[str, List[Callable[[object], None]]] = dict()
+        self._reconnect_handlers: List[Callable[[], None]] = list()
+        self._events = Queue()
+        self._connected = Event()
+        self._stop = Event()
+
+    @property
+    def connected(self) -> bool:
+        return self._connected.is_set()
+
+    def _connect(self) -> None:
+        headers, cookies = self._client.session_credentials()
+        ws = websocket.create_connection(
+            self.url, timeout=const.ABODE_EVENTS_TIMEOUT, origin=const.BASE_URL,
+            header=[f"{key}: {value}" for key, value in headers.items()],
+            cookie='; '.join(f"{key}={value}" for key, value in cookies.items()) or None)
+        message = ws.recv()
+        if not message.startswith('0'):
+            ws.close()
+            raise websocket.WebSocketException(f"Unexpected handshake from {self.name}: {message[:100]}")
+        handshake = json.loads(message[1:])
+        self._ping_interval = handshake.get('pingInterval', self._ping_interval * 1000) / 1000
+        self._ping_timeout = handshake.get('pingTimeout', self._ping_timeout * 1000) / 1000
+        ws.settimeout(self._ping_interval)
+        self._ws = ws
+        self._connected.set()
+        metrics.ABODE_EVENTS_CONNECTED.set(1, self.name)
+        log.info(f"Connected to {self.name} event feed")
+
+    def _handle(self, message: str) -> None:
+        if message == '2':
+            self._ws.send('3')
+            return
+        if message == '1' or message.startswith('41'):
+            raise websocket.WebSocketConnectionClosedException(f"{self.name} closed the event feed")
+        if message.startswith('44'):
+            raise websocket.WebSocketException(f"{self.name} refused the event feed: {message[2:]}")
+        if not message.startswith('42'):
+            return
+        try:
+            event, *data = json.loads(message[2:])
+        except ValueError:
+            log.debug(f"Ignoring malformed event from {self.name}: {message[:100]}")
+            return
+        metrics.ABODE_EVENTS_TOTAL.inc(event)
+        if event in self._handlers:
+            self._events.put((event, data[0] if data else None))
+
+    def _read(self) -> None:
+        last_ping = last_seen = time.monotonic()
+        while True:
+            try:
+                try:
+                    message = self._ws.recv()
+                    last_seen = time.monotonic()
+                except websocket.WebSocketTimeoutException:
+                    message = ''
+                if time.monotonic() - last_seen > self._ping_interval + self._ping_timeout:
+                    raise websocket.WebSocketTimeoutException(f"No answer from {self.name} in "
+                                                              f"{self._ping_interval + self._ping_timeout:.0f} seconds")
+                if time.monotonic() - last_ping >= self._ping_interval:
+                    self._ws.send('2')
+                    last_ping = time.monotonic()
+                if message:
+                    self._handle(message)
+            except (websocket.WebSocketException, OSError) as exc:
+                if not self._stop.is_set():
+                    log.warning(f"Lost connection to {self.name} event feed: {exc}")
+                break
+        self._connected.clear()
+        metrics.ABODE_EVENTS_CONNECTED.set(0, self.name)
+        self._ws.close()
+
+    def _dispatch(self) -> None:
+        while True:
+            event, data = self._events.get()
+            if event is None:
+                return
+            if event == _RECONNECTED:
+                for handler in self._reconnect_handlers:
+                    try:
+                        handler()
+                    except Exception as exc:
+                        log.error(f"Error catching up after reconnecting to {self.name} event feed", exc_info=exc)
+                continue
+            for handler in self._handlers.get(event, list()):
+                try:
+                    handler(data)
+                except Exception as exc:
+                    log.error(f"Error handling {self.name} {event} event", exc_info=exc)
+
+    def _run(self) -> None:
+        backoff = const.ABODE_EVENTS_BACKOFF_MIN
+        while not self._stop.is_set():
+            try:
+                self._connect()
+            except (websocket.WebSocketException, OSError, ValueError) as exc:
+                if getattr(exc, 'status_code', None) in (401, 403):
+                    log.info(f"{self.name} turned our access token away from the event feed, getting a new one")
+                    try:
+                        self._client.token_rejected()
+                    except Exception as renew_exc:
+                        log.warning(f"Unable to get a new {self.name} access token: {renew_exc}")
+                log.warning(f"Unable to connect to {self.name} event feed: {exc}, retrying in {backoff} seconds")
+                self._stop.wait(backoff)
+                backoff = min(backoff * 2, const.ABODE_EVENTS_BACKOFF_MAX)
+                continue
+            backoff = const.ABODE_EVENTS_BACKOFF_MIN
+            self._events.put((_RECONNECTED, None))
+            self._read()
+
+    def subscribe(self, event: str, handler: Callable[[object], None]) -> None:
+        self._handlers.setdefault(event, list()).append(handler)
+
+    def on_reconnect(self, handler: Callable[[], None]) -> None:
+        """
+        Registers a callback for every time the feed (re)connects, including the first, since
+        events sent while we weren't listening are lost.
+        """
+        self._reconnect_handlers.append(handler)
+
+    def start(self) -> None:
+        Thread(target=self._dispatch, name='abode-events', daemon=True).start()
+        Thread(target=self._run, name='abode-events-ws', daemon=True).start()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._events.put((None, None))
+        if self._ws:
+            self._ws.close()
+
+
+def is_offline(device: dict) -> bool:
+    """
+    Whether Abode says a device isn't responding, which for a camera means it can't stream.
+    """
+    return bool((device.get('faults') or dict()).get('no_response'))
+
+
+class AbodeDeviceWatcher:
+    """
+    Keeps an account's camera list and the online state of each camera up to date from the
+    event feed. Updates to cameras, and to devices we haven't seen before, fetch the device list
+    again; updates to other devices (door sensors and the like, which are busy) are ignored.
+    Listeners hear about cameras that were added, removed or renamed, and about cameras that
+    went offline or came back.
+    """
+    def __init__(self, events: AbodeEventSocket, client: AbodeApiClient) -> None:
+        self._events = events
+        self._client = client
+        self._offline: Set[str] = set()
+        self._device_ids: Set[str] = set()
+        self._camera_listeners: List[Callable[[], None]] = list()
+        self._status_listeners: List[Callable[[str, bool], None]] = list()
+        self._lock = Lock()
+
+    @property
+    def connected(self) -> bool:
+        return self._events.connected
+
+    def add_camera_listener(self, listener: Callable[[], None]) -> None:
+        self._camera_listeners.append(listener)
+
+    def add_status_listener(self, listener: Callable[[str, bool], None]) -> None:
+        """
+        Registers a callback that is given a camera id and whether it is now online, every time
+        a camera goes offline or comes back.
+        """
+        self._status_listeners.append(listener)
+
+    def _refresh(self) -> None:
+        before = {tuple(cam.to_json()) for cam in self._client.cameras}
+        self._client.refresh_devices()
+        devices = self._client.devices
+        offline = {d['id'] for d in devices if Camera.is_camera(d) and is_offline(d)}
+        with self._lock:
+            self._device_ids = {d['id'] for d in devices}
+            went_offline = offline - self._offline
+            came_back = (self._offline - offline) & {cam.id for cam in self._client.cameras}
+            self._offline = offline
+        if {tuple(cam.to_json()) for cam in self._client.cameras} != before:
+            for listener in self._camera_listeners:
+                listener()
+        for cam_id, online in [(c, False) for c in went_offline] + [(c, True) for c in came_back]:
+            log.info(f"Abode says camera {cam_id} is {'back online' if online else 'offline'}")
+            for listener in self._status_listeners:
+                listener(cam_id, online)
+
+    def _on_device_update(self, device_id) -> None:
+        if isinstance(device_id, dict):
+            device_id = device_id.get('id')
+        with self._lock:
+            known = device_id in self._device_ids
+        if known and device_id not in self._client.cameras:
+            return
+        log.debug(f"Abode device {device_id} has changed, fetching the device list")
+        self._refresh()
+
+    def start(self) -> None:
+        self._events.subscribe(DEVICE_UPDATE, self._on_device_update)
+        self._events.on_reconnect(self._refresh)
+        self._events.start()
+
+    def close(self) -> None:
+        self._events.close()
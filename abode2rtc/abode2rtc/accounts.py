@@ -0,0 +1,210 @@
+import os
+import re
+import tempfile
+import time
+from itertools import chain
+from typing import Dict, Iterator, List, Optional
+
+import const
+from abode import AbodeApiClient
+from abode_events import AbodeDeviceWatcher
+from cameras import Camera, CameraRegistry
+from logger import log
+from utils import data_path
+
+
+class AbodeAccount:
+    """
+    One Abode login. The account from the top-level `abode_username` and `abode_password` options
+    has no name, so its state file and stream names are the same as they were before accounts
+    could be added; every other account has a name, which is used for its state file and in front
+    of the stream names we make up for its cameras.
+    """
+    def __init__(self, username: str, password: str, locale: str = None, name: str = '') -> None:
+        self.name = name
+        self.username = username
+        self.password = password
+        self.locale = locale or const.DEFAULT_LOCALE
+        self.client: Optional[AbodeApiClient] = None
+        self.events: Optional[AbodeDeviceWatcher] = None
+        self.login_rejected = False
+        self._login_failures = 0
+        self._next_login = 0.0
+
+    @property
+    def label(self) -> str:
+        return f"Abode account {self.name}" if self.name else "Abode account"
+
+    @property
+    def state_path(self) -> str:
+        return data_path(f"abode-{self.name}.json" if self.name else 'abode.json')
+
+    @property
+    def offline_path(self) -> str:
+        return os.path.join(tempfile.gettempdir(), f"abode-offline-{self.name}.json" if self.name
+                            else 'abode-offline.json')
+
+    def stream_name(self, slug: str) -> str:
+        return f"{self.name}_{slug}" if self.name else slug
+
+    def _client_kwargs(self) -> dict:
+        return dict(username=self.username, password=self.password, locale=self.locale, account=self.name or None)
+
+    def load(self, path: str = None, refresh_token_in_background: bool = False) -> AbodeApiClient:
+        """
+        Returns a client restored from the account's saved state, without logging in.
+        """
+        return AbodeApiClient.load(path or self.state_path, refresh_token_in_background=refresh_token_in_background,
+                                   **self._client_kwargs())
+
+    def restore(self) -> bool:
+        try:
+            self.client = self.load(refresh_token_in_background=True)
+        except (IOError, KeyError, ValueError) as exc:
+            log.info(f"No usable saved state for {self.label} ({exc}), logging in from scratch")
+            return False
+        return True
+
+    def login(self) -> None:
+        client = AbodeApiClient(refresh_token_in_background=True, **self._client_kwargs())
+        client.cameras
+        client.save(self.state_path)
+        self.client = client
+
+    @property
+    def login_due(self) -> bool:
+        """
+        Whether to try logging in again: not once Abode has turned the credentials away, and
+        otherwise only once the backoff from the last failure has run out.
+        """
+        return not self.login_rejected and time.monotonic() >= self._next_login
+
+    def login_failed(self, exc: Exception) -> Optional[float]:
+        """
+        Records a failed login and returns how long to wait before the next one, or None if Abode
+        rejected the credentials, which won't change until the add-on's options do.
+        """
+        if getattr(getattr(exc, 'response', None), 'status_code', None) in (401, 403):
+            self.login_rejected = True
+            return None
+        self._login_failures += 1
+        delay = min(const.LOGIN_BACKOFF_MIN * 2 ** (self._login_failures - 1), const.LOGIN_BACKOFF_MAX)
+        self._next_login = time.monotonic() + delay
+        return delay
+
+    def revalidate(self) -> None:
+        try:
+            self.client.ensure_token()
+            self.client.refresh_devices()
+            self.client.save()
+        except Exception as exc:
+            log.error(f"Unable to refresh camera list from {self.label}, keeping the saved one", exc_info=exc)
+
+
+class AccountCameras:
+    """
+    The cameras of every account that is logged in, looked up as if they were one registry.
+    Camera ids are unique across accounts; if two accounts have a camera with the same name, the
+    one on the account listed first wins.
+    """
+    def __init__(self, accounts: 'AbodeAccounts') -> None:
+        self._accounts = accounts
+
+    def _registries(self) -> List[CameraRegistry]:
+        return [account.client.cameras for account in self._accounts.ready]
+
+    def get(self, key: str) -> Optional[Camera]:
+        for registry in self._registries():
+            cam = registry.get(key)
+            if cam:
+                return cam
+        return None
+
+    def lookup(self, key: str) -> Camera:
+        cam = self.get(key)
+        if cam is None:
+            raise KeyError(f"Camera {key} not found")
+        return cam
+
+    @property
+    def slugs(self) -> Dict[str, str]:
+        slugs = dict()
+        for registry in self._registries():
+            slugs.update(registry.slugs)
+        return slugs
+
+    def __iter__(self) -> Iterator[Camera]:
+        return chain.from_iterable(self._registries())
+
+    def __len__(self) -> int:
+        return sum(len(registry) for registry in self._registries())
+
+
+class AbodeAccounts:
+    """
+    Every Abode account the add-on streams from. Each has its own client, and so its own access
+    token, connection pool and circuit breaker, so an account that is slow or locked out only
+    affects its own cameras.
+    """
+    def __init__(self, accounts: List[AbodeAccount]) -> None:
+        self._accounts = accounts
+        self.cameras = AccountCameras(self)
+
+    @classmethod
+    def from_options(cls, username: str, password: str, locale: str = None,
+                     accounts: List[dict] = None) -> 'AbodeAccounts':
+        """
+        Builds the account list from the add-on options: the top-level credentials, then each
+        entry of `accounts`. Entries without credentials or with a name that's already taken are
+        skipped, and so are empty top-level credentials unless there is no other account.
+        """
+        result = [AbodeAccount(username, password, locale)]
+        for options in accounts or list():
+            name = re.sub(r'[^a-z0-9_]+', '_', (options.get('name') or '').lower()).strip('_')
+            if not name or not options.get('abode_username') or not options.get('abode_password'):
+                log.error(f"Ignoring Abode account '{options.get('name')}', it needs a name, username and password")
+                continue
+            if any(account.name == name for account in result):
+                log.error(f"Ignoring Abode account '{options.get('name')}', there is already an account named {name}")
+                continue
+            result.append(AbodeAccount(options['abode_username'], options['abode_password'],
+                                       options.get('locale') or locale, name))
+        if len(result) > 1 and not (username and password):
+            log.info("No top-level Abode username and password, using only the other Abode accounts")
+            result = result[1:]
+        return cls(result)
+
+    def for_state_path(self, path: str) -> AbodeAccount:
+        """
+        Returns the account a state file belongs to, or the first account if none match.
+        """
+        path = os.path.abspath(path)
+        return next((account for account in self._accounts if account.state_path == path), self._accounts[0])
+
+    @property
+    def ready(self) -> List[AbodeAccount]:
+        """
+        The accounts we have a client for, either logged in or restored from saved state.
+        """
+        return [account for account in self._accounts if account.client]
+
+    def find(self, key: str) -> tuple:
+        """
+        Returns the account and camera for a camera id, UUID, name or slug.
+        """
+        for account in self.ready:
+            cam = account.client.cameras.get(key)
+            if cam:
+                return account, cam
+        raise KeyError(f"Camera {key} not found")
+
+    def set_slugs(self, slugs: Dict[str, str]) -> None:
+        for account in self.ready:
+            account.client.cameras.set_slugs(slugs)
+            account.client.save()
+
+    def __iter__(self) -> Iterator[AbodeAccount]:
+        return iter(self._accounts)
+
+    def __len__(self) -> int:
+        return len(self._accounts)
@@ -0,0 +1,113 @@
+import time
+from contextlib import contextmanager
+from itertools import count
+from threading import Condition
+from typing import Dict, List
+
+import const
+import metrics
+
+
+class AdmissionError(Exception):
+    pass
+
+
+class _Ticket:
+    __slots__ = ('key', 'rank', 'evicted')
+
+    def __init__(self, key: str, priority: int, seq: int) -> None:
+        self.key = key
+        self.rank = (-priority, seq)
+        self.evicted = False
+
+
+class AdmissionController:
+    """
+    Limits how many KVS sessions are being set up at once, in total and per camera, so that
+    opening a whole dashboard queues up instead of running into Abode's limits part way through.
+    Callers that can't start straight away wait in a queue ordered by priority and then by
+    arrival; a caller whose camera is already at its limit doesn't hold up the cameras behind
+    it. If the queue is full, a newcomer takes the place of the lowest ranked caller if it
+    outranks it, so background work can't crowd out viewers. Whoever loses out, or has waited
+    `timeout` seconds, gets an AdmissionError so that the viewer gets a quick answer rather than
+    a hang.
+    """
+    def __init__(self, name: str, max_active: int = const.KVS_MAX_SESSIONS,
+                 max_per_key: int = const.KVS_MAX_PER_CAMERA, max_queue: int = const.KVS_QUEUE_SIZE,
+                 timeout: float = const.KVS_QUEUE_TIMEOUT) -> None:
+        self.name = name
+        self._max_active = max_active
+        self._max_per_key = max_per_key
+        self._max_queue = max_queue
+        self._timeout = timeout
+        self._active = 0
+        self._active_by_key: Dict[str, int] = dict()
+        self._queue: List[_Ticket] = list()
+        self._seq = count()
+        self._cond = Condition()
+        metrics.ADMISSION_QUEUE_DEPTH.set(0, name)
+        metrics.ADMISSION_ACTIVE.set(0, name)
+
+    def _has_room(self, key: str) -> bool:
+        return self._active < self._max_active and self._active_by_key.get(key, 0) < self._max_per_key
+
+    def _next(self) -> _Ticket:
+        eligible = [t for t in self._queue if self._active_by_key.get(t.key, 0) < self._max_per_key]
+        return min(eligible, key=lambda t: t.rank, default=None)
+
+    def _wait(self, key: str, priority: int) -> None:
+        if not self._queue and self._has_room(key):
+            return
+        ticket = _Ticket(key, priority, next(self._seq))
+        if len(self._queue) >= self._max_queue:
+            worst = max(self._queue, key=lambda t: t.rank, default=None)
+            if worst is None or worst.rank < ticket.rank:
+                metrics.ADMISSION_REJECTED_TOTAL.inc(self.name, 'full')
+                raise AdmissionError(f"Too many cameras are being opened at once, try {key} again in a moment")
+            worst.evicted = True
+            self._queue.remove(worst)
+            self._cond.notify_all()
+        self._queue.append(ticket)
+        metrics.ADMISSION_QUEUE_DEPTH.set(len(self._queue), self.name)
+        deadline = time.monotonic() + self._timeout
+        try:
+            while not (self._has_room(key) and self._next() is ticket):
+                if ticket.evicted:
+                    metrics.ADMISSION_REJECTED_TOTAL.inc(self.name, 'evicted')
+                    raise AdmissionError(f"Too many cameras are being opened at once, {key} made way for "
+                                         f"one with a higher priority")
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    metrics.ADMISSION_REJECTED_TOTAL.inc(self.name, 'timeout')
+                    raise AdmissionError(f"Waited {self._timeout:.0f} seconds to open camera {key}, giving up")
+                self._cond.wait(remaining)
+        finally:
+            if not ticket.evicted:
+                self._queue.remove(ticket)
+            metrics.ADMISSION_QUEUE_DEPTH.set(len(self._queue), self.name)
+            # Whoever is next may have been waiting on us rather than on a free slot
+            self._cond.notify_all()
+
+    @contextmanager
+    def admit(self, key: str, priority: int = 0):
+        """
+        Waits for a slot to set up a session for `key`. Higher priorities go first.
+        """
+        start = time.monotonic()
+        with self._cond:
+            self._wait(key, priority)
+            self._active += 1
+            self._active_by_key[key] = self._active_by_key.get(key, 0) + 1
+            metrics.ADMISSION_ACTIVE.set(self._active, self.name)
+        metrics.ADMISSION_WAIT_SECONDS.observe(time.monotonic() - start, self.name)
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._active -= 1
+                if self._active_by_key[key] == 1:
+                    del self._active_by_key[key]
+                else:
+                    self._active_by_key[key] -= 1
+                metrics.ADMISSION_ACTIVE.set(self._active, self.name)
+                self._cond.notify_all()
@@ -0,0 +1,259 @@
+import json
+import os
+import tempfile
+import time
+from threading import Event, Lock, Thread
+from dataclasses import asdict
+from typing import Callable, Dict, Optional
+from urllib.parse import quote
+
+import const
+import metrics
+from kvs import KVSEndpointData
+from logger import log
+from utils import atomic_write_json, file_lock
+
+
+class KVSCache:
+    """
+    Per-camera cache of KVS endpoints. Entries are kept until their signature or ICE credentials
+    are about to expire, and a background thread refreshes entries for recently used cameras
+    shortly before that happens, so reopening a camera doesn't have to wait for Abode.
+    """
+    def __init__(self, loader: Callable[[str], KVSEndpointData]) -> None:
+        self._loader = loader
+        self._entries: Dict[str, KVSEndpointData] = dict()
+        self._last_used: Dict[str, float] = dict()
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+
+    def get(self, cam_id: str) -> Optional[KVSEndpointData]:
+        with self._lock:
+            self._last_used[cam_id] = time.time()
+            entry = self._entries.get(cam_id)
+            if entry and not entry.expires_within(const.KVS_EXPIRY_MARGIN):
+                return entry
+            return None
+
+    def put(self, cam_id: str, entry: KVSEndpointData) -> None:
+        with self._lock:
+            self._entries[cam_id] = entry
+
+    def invalidate(self, cam_id: str) -> None:
+        with self._lock:
+            self._entries.pop(cam_id, None)
+
+    def _due_for_refresh(self) -> list:
+        now = time.time()
+        with self._lock:
+            for cam_id in [c for c, t in self._last_used.items() if now - t > const.KVS_PREFETCH_IDLE]:
+                log.debug(f"Camera {cam_id} hasn't been opened recently, dropping cached KVS endpoint")
+                self._last_used.pop(cam_id)
+                self._entries.pop(cam_id, None)
+            return [c for c, e in self._entries.items() if e.needs_refresh()]
+
+    def refresh(self) -> None:
+        for cam_id in self._due_for_refresh():
+            log.debug(f"Prefetching KVS endpoint for camera {cam_id}")
+            try:
+                self.put(cam_id, self._loader(cam_id))
+            except Exception as exc:
+                log.warning(f"Unable to prefetch KVS endpoint for camera {cam_id}: {exc}")
+                self.invalidate(cam_id)
+
+    def _run(self) -> None:
+        while not self._stop.wait(const.KVS_PREFETCH_INTERVAL):
+            self.refresh()
+
+    def start(self) -> None:
+        if self._thread:
+            return
+        self._thread = Thread(target=self._run, name='kvs-prefetch', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+class _Flight:
+    __slots__ = ('done', 'result', 'error', 'waiters')
+
+    def __init__(self) -> None:
+        self.done = Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+
+class SingleFlight:
+    """
+    Runs at most one call per key at a time. Anyone asking for a key that is already in flight
+    waits for that call and shares its result (or its exception), so a burst of viewers for one
+    camera makes a single request to Abode. Calls for different keys don't wait for each other.
+    How many callers each call served goes into `histogram`, and `label` says what a call is in
+    the log.
+    """
+    def __init__(self, histogram: metrics.Histogram = metrics.KVS_REQUESTS_PER_CALL,
+                 label: str = 'KVS stream request') -> None:
+        self._flights: Dict[str, _Flight] = dict()
+        self._histogram = histogram
+        self._label = label
+        self._lock = Lock()
+
+    def do(self, key: str, fn: Callable, *args):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                flight.waiters += 1
+        if not leader:
+            flight.done.wait()
+            if flight.error:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = fn(*args)
+            return flight.result
+        except BaseException as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+            self._histogram.observe(flight.waiters + 1)
+            if flight.waiters:
+                log.debug(f"One {self._label} for {key} served {flight.waiters + 1} viewers")
+
+
+class SharedKVSCache:
+    """
+    The cross-process counterpart of SingleFlight, for standalone `stream.py` resolvers: a file
+    lock per camera lets one process ask Abode for an endpoint while the others wait, and the
+    endpoint is saved to a file so that they can use it instead of asking again.
+    """
+    def __init__(self, directory: str = None) -> None:
+        self._dir = directory or tempfile.gettempdir()
+
+    def _path(self, cam_id: str) -> str:
+        return os.path.join(self._dir, f"abode-kvs-{quote(cam_id, safe='')}.json")
+
+    def _read(self, path: str) -> Optional[KVSEndpointData]:
+        try:
+            with open(path, 'r') as f:
+                return KVSEndpointData(**json.load(f))
+        except (IOError, ValueError, TypeError):
+            return None
+
+    def get(self, cam_id: str, loader: Callable[[str], KVSEndpointData]) -> KVSEndpointData:
+        path = self._path(cam_id)
+        with file_lock(path + '.lock'):
+            entry = self._read(path)
+            if entry and not entry.expires_within(const.KVS_EXPIRY_MARGIN):
+                log.debug(f"Using KVS endpoint for camera {cam_id} fetched by another resolver")
+                return entry
+            entry = loader(cam_id)
+            try:
+                atomic_write_json(path, asdict(entry))
+            except IOError as exc:
+                log.warning(f"Unable to share KVS endpoint for camera {cam_id}: {exc}")
+            return entry
+
+
+class OfflineCache:
+    """
+    Remembers cameras that Abode reported as offline, so we can fail fast instead of asking
+    again for every viewer. Each consecutive failure doubles the time before the camera is tried
+    again, and a background thread probes cameras once their backoff has run out. The cache is
+    saved to a file so that standalone `stream.py` resolvers share it.
+    """
+    def __init__(self, probe: Callable[[str], bool] = None, path: str = None) -> None:
+        self._probe = probe
+        self._path = path or self._temp_path()
+        self._entries: Dict[str, dict] = dict()
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+        self._load()
+
+    @staticmethod
+    def _temp_path() -> str:
+        return os.path.join(tempfile.gettempdir(), 'abode-offline.json')
+
+    def _load(self) -> None:
+        try:
+            with open(self._path, 'r') as f:
+                self._entries = json.load(f)
+        except (IOError, ValueError):
+            self._entries = dict()
+
+    def _save(self) -> None:
+        try:
+            atomic_write_json(self._path, self._entries)
+        except IOError as exc:
+            log.warning(f"Unable to save offline camera cache to {self._path}: {exc}")
+
+    def is_offline(self, cam_id: str) -> bool:
+        """
+        Whether to fail fast for a camera. With a probe, a camera stays offline until the probe
+        finds it back; without one (in `stream.py`) it is only offline until its backoff runs out,
+        so that the next viewer tries it again.
+        """
+        with self._lock:
+            entry = self._entries.get(cam_id)
+            if entry is None:
+                return False
+            return self._probe is not None or entry['retry_at'] > time.time()
+
+    def retry_in(self, cam_id: str) -> float:
+        with self._lock:
+            entry = self._entries.get(cam_id)
+            return max(0, entry['retry_at'] - time.time()) if entry else 0
+
+    def mark_offline(self, cam_id: str, backoff: float = None) -> None:
+        with self._lock:
+            failures = self._entries.get(cam_id, {}).get('failures', 0) + 1
+            if backoff is None:
+                backoff = min(const.OFFLINE_BACKOFF_MIN * 2 ** (failures - 1), const.OFFLINE_BACKOFF_MAX)
+            self._entries[cam_id] = {'failures': failures, 'retry_at': time.time() + backoff}
+            self._save()
+        log.info(f"Camera {cam_id} is offline, will check again in {backoff} seconds")
+
+    def mark_online(self, cam_id: str) -> None:
+        with self._lock:
+            if self._entries.pop(cam_id, None) is None:
+                return
+            self._save()
+        log.info(f"Camera {cam_id} is back online")
+
+    def probe(self) -> None:
+        now = time.time()
+        with self._lock:
+            due = [c for c, e in self._entries.items() if e['retry_at'] <= now]
+        for cam_id in due:
+            log.debug(f"Checking whether camera {cam_id} is back online")
+            try:
+                online = self._probe(cam_id)
+            except Exception as exc:
+                log.warning(f"Unable to check whether camera {cam_id} is online: {exc}")
+                online = False
+            if online:
+                self.mark_online(cam_id)
+            else:
+                self.mark_offline(cam_id)
+
+    def _run(self) -> None:
+        while not self._stop.wait(const.OFFLINE_PROBE_INTERVAL):
+            self.probe()
+
+    def start(self) -> None:
+        if self._thread or not self._probe:
+            return
+        self._thread = Thread(target=self._run, name='offline-probe', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
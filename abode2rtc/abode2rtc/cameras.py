@@ -0,0 +1,174 @@
+from threading import Lock
+from typing import Dict, Iterable, Iterator, List, Optional
+
+import const
+
+_HEX_DIGITS = frozenset('0123456789abcdef')
+
+
+class Camera:
+    """
+    The handful of fields we use from an Abode camera device.
+    """
+    __slots__ = ('id', 'uuid', 'name', 'can_stream_247')
+
+    def __init__(self, id: str, uuid: str, name: str, can_stream_247: bool = False) -> None:
+        self.id = id
+        self.uuid = uuid
+        self.name = name
+        self.can_stream_247 = bool(can_stream_247)
+
+    @classmethod
+    def from_device(cls, device: dict) -> 'Camera':
+        return cls(device['id'], device['uuid'], device['name'], device.get('canStream247'))
+
+    @staticmethod
+    def is_camera(device: dict) -> bool:
+        return device.get('type_tag') == const.CAMERA_TYPE and device.get('origin') == 'abode_cam'
+
+    def to_json(self) -> list:
+        return [self.id, self.uuid, self.name, self.can_stream_247]
+
+    @classmethod
+    def from_json(cls, data: list) -> 'Camera':
+        return cls(*data)
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Camera) and self.to_json() == other.to_json()
+
+    def __hash__(self) -> int:
+        return hash(self.id)
+
+    def __repr__(self) -> str:
+        return f"Camera({self.id!r}, {self.uuid!r}, {self.name!r}, {self.can_stream_247!r})"
+
+
+class CameraRegistry:
+    """
+    The cameras on an Abode account, indexed by id, UUID, name and go2rtc slug so that every
+    lookup is a dict access. When the device list changes only the cameras that were added,
+    removed or changed are re-indexed.
+    """
+    def __init__(self, cameras: Iterable[Camera] = ()) -> None:
+        self._by_id: Dict[str, Camera] = dict()
+        self._by_uuid: Dict[str, Camera] = dict()
+        self._by_name: Dict[str, Camera] = dict()
+        self._by_slug: Dict[str, Camera] = dict()
+        self._slugs: Dict[str, str] = dict()
+        self._lock = Lock()
+        self.update(cameras)
+
+    def _index(self, cam: Camera) -> None:
+        self._by_id[cam.id] = cam
+        self._by_uuid[cam.uuid] = cam
+        self._by_name.setdefault(cam.name, cam)
+        slug = self._slugs.get(cam.id)
+        if slug:
+            self._by_slug[slug] = cam
+
+    def _unindex(self, cam: Camera) -> None:
+        self._by_id.pop(cam.id, None)
+        self._by_uuid.pop(cam.uuid, None)
+        if self._by_name.get(cam.name) is cam:
+            del self._by_name[cam.name]
+            # Another camera may share the name; let it take over the name index
+            for other in self._by_id.values():
+                if other.name == cam.name:
+                    self._by_name[cam.name] = other
+                    break
+        slug = self._slugs.get(cam.id)
+        if slug and self._by_slug.get(slug) is cam:
+            del self._by_slug[slug]
+
+    def update(self, cameras: Iterable[Camera]) -> bool:
+        """
+        Replaces the camera list, re-indexing only what changed. Returns True if anything did.
+        """
+        cameras = {cam.id: cam for cam in cameras}
+        with self._lock:
+            removed = [cam for cam_id, cam in self._by_id.items() if cam_id not in cameras]
+            changed = [cam for cam_id, cam in cameras.items() if self._by_id.get(cam_id) != cam]
+            for cam in removed:
+                self._unindex(cam)
+                self._slugs.pop(cam.id, None)
+            for cam in changed:
+                if cam.id in self._by_id:
+                    self._unindex(self._by_id[cam.id])
+                self._index(cam)
+            return bool(removed or changed)
+
+    def update_from_devices(self, devices: List[dict]) -> bool:
+        return self.update(Camera.from_device(d) for d in devices if Camera.is_camera(d))
+
+    def set_slugs(self, slugs: Dict[str, str]) -> None:
+        """
+        Sets the go2rtc slug for each camera, as a dict of camera id to slug.
+        """
+        with self._lock:
+            self._slugs = {cam_id: slug for cam_id, slug in slugs.items() if cam_id in self._by_id}
+            self._by_slug = {slug: self._by_id[cam_id] for cam_id, slug in self._slugs.items()}
+
+    @property
+    def slugs(self) -> Dict[str, str]:
+        return dict(self._slugs)
+
+    def by_id(self, cam_id: str) -> Camera:
+        try:
+            return self._by_id[cam_id]
+        except KeyError:
+            raise KeyError(f"Camera with id {cam_id} not found") from None
+
+    def by_uuid(self, cam_uuid: str) -> Camera:
+        try:
+            return self._by_uuid[cam_uuid]
+        except KeyError:
+            raise KeyError(f"Camera with UUID {cam_uuid} not found") from None
+
+    def by_name(self, cam_name: str) -> Camera:
+        try:
+            return self._by_name[cam_name]
+        except KeyError:
+            raise KeyError(f"Camera with name '{cam_name}' not found") from None
+
+    def by_slug(self, slug: str) -> Camera:
+        try:
+            return self._by_slug[slug]
+        except KeyError:
+            raise KeyError(f"Camera with slug {slug} not found") from None
+
+    def get(self, key: str) -> Optional[Camera]:
+        """
+        Finds a camera by id, UUID, name or slug, or returns None.
+        """
+        if key.startswith('XF:'):
+            return self._by_id.get(key)
+        if len(key) == 32 and _HEX_DIGITS.issuperset(key):
+            return self._by_uuid.get(key)
+        return self._by_name.get(key) or self._by_slug.get(key)
+
+    def lookup(self, key: str) -> Camera:
+        cam = self.get(key)
+        if cam is None:
+            raise KeyError(f"Camera {key} not found")
+        return cam
+
+    def __iter__(self) -> Iterator[Camera]:
+        return iter(list(self._by_id.values()))
+
+    def __len__(self) -> int:
+        return len(self._by_id)
+
+    def __contains__(self, cam_id: str) -> bool:
+        return cam_id in self._by_id
+
+    def to_json(self) -> dict:
+        return {
+            'cameras': [cam.to_json() for cam in self._by_id.values()],
+            'slugs': self._slugs
+        }
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'CameraRegistry':
+        self = cls(Camera.from_json(c) for c in data.get('cameras') or list())
+        self.set_slugs(data.get('slugs') or dict())
+        return self
@@ -7,6 +7,15 @@ from utils import obscure_passwords
 import const
 
 
+def load_options(config_path=const.DEFAULT_CONFIG_PATH) -> dict:
+    try:
+        with open(config_path, 'r') as f:
+            return json.load(f)
+    except IOError as exc:
+        log.error(f"Could not read Home Assistant config from {config_path}", exc_info=exc)
+        return dict()
+
+
 class EnvDefault(argparse.Action):
     def __init__(self, envvar, required=True, default=None, **kwargs):
         if not default and envvar:
@@ -68,15 +77,10 @@ class ConfigParser:
         })
 
     def _load_options(self, config_path=const.DEFAULT_CONFIG_PATH):
-        try:
-            with open(config_path, 'r') as f:
-                return json.load(f)
-        except IOError as exc:
-            log.error(f"Could not read Home Assistant config from {self.config_file}", exc_info=exc)
-            return dict()
+        return load_options(config_path)
 
     def __getattr__(self, name):
-        if getattr(self._args, name):
+        if getattr(self._args, name, None):
             return getattr(self._args, name)
         if name in self._options:
             return self._options[name]
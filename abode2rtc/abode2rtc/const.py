@@ -1,10 +1,14 @@
-BASE_URL = 'https://my.goabode.com'
+import os
+
+BASE_URL = os.environ.get('ABODE_BASE_URL', 'https://my.goabode.com')
 CAMERA_TYPE = 'device_type.mini_cam'
 ERR_CAMERA_OFFLINE = 2604
 
+DATA_DIR = os.environ.get('ABODE2RTC_DATA_DIR', '/data')
 DEFAULT_CONFIG_PATH = '/data/options.json'
 DEFAULT_SUPERVISOR_URL = 'http://supervisor'
 DEFAULT_LOCALE = 'en-US'
+DEFAULT_API_HOST = '127.0.0.1'
 
 DEFAULT_PORTS = {
     'api': 3000,
@@ -13,4 +17,79 @@ DEFAULT_PORTS = {
     'webrtc': 8555
 }
 
-TOKEN_REFRESH_INTERVAL = 3000  # every 50 minutes
+TOKEN_LIFETIME = 3600  # used when the access token doesn't carry an expiry
+TOKEN_EXPIRY_MARGIN = 300  # renew tokens that expire within 5 minutes
+TOKEN_REFRESH_MARGIN = 600  # refresh in the background 10 minutes before expiry...
+TOKEN_REFRESH_JITTER = 120  # ...plus up to 2 minutes earlier
+TOKEN_RETRY_MIN = 15  # retry a failed background refresh after 15 seconds...
+TOKEN_RETRY_MAX = 600  # ...doubling each time, up to 10 minutes
+
+KVS_DEFAULT_TTL = 300  # used when a KVS endpoint doesn't say how long its signature lasts
+KVS_EXPIRY_MARGIN = 30  # don't hand out endpoints that expire within 30 seconds
+KVS_PREFETCH_MARGIN = 90  # refresh cached endpoints this long before they expire
+KVS_PREFETCH_IDLE = 600  # stop refreshing cameras nobody has opened for 10 minutes
+KVS_PREFETCH_INTERVAL = 15
+
+KVS_MAX_SESSIONS = 4  # KVS sessions being set up at once, per Abode account...
+KVS_MAX_PER_CAMERA = 1  # ...and per camera
+KVS_QUEUE_SIZE = 64  # cameras that can wait for a slot before we turn viewers away
+KVS_QUEUE_TIMEOUT = 30  # give up on a slot after 30 seconds
+KVS_BACKGROUND_PRIORITY = -1  # prefetching and offline probes wait behind viewers
+
+OFFLINE_BACKOFF_MIN = 30  # first retry for an offline camera after 30 seconds...
+OFFLINE_BACKOFF_MAX = 900  # ...doubling each time, up to 15 minutes
+OFFLINE_PROBE_INTERVAL = 10
+
+HTTP_CONNECT_TIMEOUT = 5
+HTTP_READ_TIMEOUT = 20
+HTTP_POOL_SIZE = 4
+ABODE_POOL_SIZE = 16  # a dashboard can open every camera at once
+HTTP_RETRIES = 2
+HTTP_BACKOFF_BASE = 0.5  # first retry after about half a second...
+HTTP_BACKOFF_MAX = 10  # ...doubling each time, up to 10 seconds
+HTTP_BREAKER_THRESHOLD = 5  # stop calling a service after 5 failures in a row...
+HTTP_BREAKER_RESET = 30  # ...and try it again after 30 seconds
+
+WARM_MAX_STREAMS = 2  # default cap on always-on streams, to limit upload bandwidth
+WARM_IDLE_TIMEOUT = 1800  # let an always-on camera go cold after 30 minutes without viewers
+WARM_RENEW_INTERVAL = 2700  # reconnect unwatched always-on streams every 45 minutes for a fresh KVS session
+WARM_CONNECTS_PER_HOUR = 6  # per camera, so a flapping camera can't keep starting KVS sessions
+WARM_RETRY_DELAY = 30
+WARM_CHECK_INTERVAL = 30
+WARM_READ_TIMEOUT = 60
+
+PREROLL_IDLE_TIMEOUT = 60  # stop a pre-rolled stream nobody has opened after a minute
+PREROLL_STARTS_PER_HOUR = 10  # per camera, so a flapping sensor can't keep starting KVS sessions
+PREROLL_CHECK_INTERVAL = 5
+
+HEALTH_PUBLISH_INTERVAL = 30  # send changed stream health entities to Home Assistant at most every 30 seconds
+HEALTH_REFRESH_INTERVAL = 900  # and all of them every 15 minutes, in case Home Assistant restarted
+
+SNAPSHOT_TTL = 300  # default age at which snapshots of cameras that aren't streaming are retaken
+SNAPSHOT_ACTIVE_TTL = 5  # retake snapshots of cameras that are streaming after 5 seconds
+SNAPSHOT_CAPTURE_TIMEOUT = 30
+
+PROFILE_KEEP = 20  # profile files to keep
+
+GO2RTC_STARTUP_TIMEOUT = 30
+GO2RTC_STOP_TIMEOUT = 10
+GO2RTC_HEALTH_INTERVAL = 10  # check go2rtc's API every 10 seconds...
+GO2RTC_HEALTH_TIMEOUT = 5
+GO2RTC_HEALTH_FAILURES = 3  # ...and restart it if it fails to answer 3 times in a row
+GO2RTC_RESTART_MIN = 1  # restart go2rtc after 1 second...
+GO2RTC_RESTART_MAX = 60  # ...doubling each time it fails again, up to a minute
+GO2RTC_STABLE_AFTER = 120  # go2rtc that ran this long before failing starts the backoff over
+GO2RTC_DOWNLOAD_CHUNK = 1 << 20
+DEVICE_POLL_INTERVAL = 300  # check Abode for new or removed cameras every 5 minutes...
+DEVICE_POLL_INTERVAL_EVENTS = 3600  # ...or every hour while the event feed is telling us about changes
+LOGIN_BACKOFF_MIN = 300  # try an account that couldn't log in again after 5 minutes...
+LOGIN_BACKOFF_MAX = 21600  # ...doubling each time, up to 6 hours, so a bad password can't get it locked out
+
+ABODE_EVENTS_TIMEOUT = 10
+ABODE_EVENTS_PING_INTERVAL = 25  # used until Abode tells us its own
+ABODE_EVENTS_BACKOFF_MIN = 1
+ABODE_EVENTS_BACKOFF_MAX = 300
+
+HASS_WS_TIMEOUT = 10
+HASS_WS_BACKOFF_MIN = 1
+HASS_WS_BACKOFF_MAX = 60
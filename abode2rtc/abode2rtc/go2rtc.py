@@ -1,66 +1,475 @@
+import hashlib
+import json
 import os
-import sys
-import tempfile
+import platform
+import re
+import shutil
+import subprocess
+import time
+from threading import Event, Lock, Thread
+from typing import Callable, Optional
+from urllib.parse import quote
 
 import requests
-import jsonpath
 
-from logger import log
+import const
+import metrics
+from logger import log, go2rtc_log, DEBUG, INFO, WARNING, ERROR
+from transport import Transport
+from utils import atomic_write_json, data_path
 
 GO2RTC_REPO = 'AlexxIT/go2rtc'
-GO2RTC_BIN = 'go2rtc_linux_amd64'
+# platform.machine() to the suffix go2rtc uses for its Linux release binaries
+GO2RTC_ARCHES = {
+    'x86_64': 'amd64',
+    'amd64': 'amd64',
+    'aarch64': 'arm64',
+    'arm64': 'arm64',
+    'armv7l': 'arm',
+    'armv7': 'arm',
+    'armv6l': 'armv6',
+    'i386': 'i386',
+    'i686': 'i386',
+}
+_github = Transport('GitHub', pool_size=1, timeout=(const.HTTP_CONNECT_TIMEOUT, 60))
 
+GO2RTC_LEVELS = {b'ERR': ERROR, b'WRN': WARNING, b'INF': INFO, b'DBG': DEBUG, b'TRC': DEBUG}
 
-def download_go2rtc() -> str:
+
+def go2rtc_asset_name(machine: str = None) -> str:
     """
-    Downloads the most recent copy of go2rtc for our platform, from the project's
-    releases page on Github.
+    Works out which go2rtc release binary runs on this machine.
     """
-    # Get the list of releases for the go2rtc project:
-    response = requests.get(f'https://api.github.com/repos/{GO2RTC_REPO}/releases')
+    machine = (machine or platform.machine()).lower()
+    if machine not in GO2RTC_ARCHES:
+        raise Exception(f"go2rtc doesn't publish a binary for {machine}")
+    return f"go2rtc_linux_{GO2RTC_ARCHES[machine]}"
+
+
+def _cache_dir() -> str:
+    return data_path('go2rtc')
+
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _download(url: str, path: str, headers: dict = None) -> None:
+    """
+    Downloads `url` to `path` in chunks. A partial download left by an earlier attempt is resumed
+    rather than started over, if the server supports it.
+    """
+    part = path + '.part'
+    headers = dict(headers or dict())
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    if offset:
+        headers['Range'] = f"bytes={offset}-"
+    response = _github.request('GET', url, headers=headers, stream=True)
+    if response.status_code == 416:
+        # The partial file is already complete (or is junk); start again to be safe
+        os.unlink(part)
+        return _download(url, path, headers={k: v for k, v in headers.items() if k != 'Range'})
     response.raise_for_status()
-    data = response.json()
-
-    # Find the first release that is not a draft or prerelease:
-    releases = jsonpath.findall("$[?(@.draft==false && @.prerelease==false)]", data)
-    if len(releases) == 0:
-        raise Exception(f"No releases found on Github for project {GO2RTC_REPO}")
-    log.info(f"Current release of go2rtc is {releases[0]['tag_name']}")
-
-    # Now that we have the most recent release, find the asset for our platform:
-    assets = jsonpath.findall(f"$.assets[?(@.name=='{GO2RTC_BIN}')]", releases[0])
-    if len(assets) == 0:
-        raise Exception(f"No {GO2RTC_BIN} binary found for {GO2RTC_REPO}")
-    asset_url = assets[0]['url']
-
-    # Download the asset to a temporary location and make it executable:
-    log.info(f"Downloading version {releases[0]['tag_name']} of {GO2RTC_BIN} from {asset_url}")
-    response = requests.get(asset_url, stream=True, headers={"Accept": assets[0]["content_type"]})
-    with tempfile.NamedTemporaryFile('wb', delete=False) as f:
-        for chunk in response.iter_content(chunk_size=16384):
+    mode = 'ab' if offset and response.status_code == 206 else 'wb'
+    if offset and mode == 'ab':
+        log.info(f"Resuming download of {os.path.basename(path)} from {offset} bytes")
+    with response, open(part, mode) as f:
+        for chunk in response.iter_content(chunk_size=const.GO2RTC_DOWNLOAD_CHUNK):
             f.write(chunk)
-        os.chmod(f.name, 0o0755)
-        return f.name
+    os.replace(part, path)
+
+
+def _latest_release(asset_name: str) -> tuple:
+    """
+    Returns the tag, download URL and SHA-256 digest (if GitHub has one) of the latest go2rtc
+    release binary for our platform.
+    """
+    response = _github.request('GET', f'https://api.github.com/repos/{GO2RTC_REPO}/releases/latest')
+    response.raise_for_status()
+    release = response.json()
+    asset = next((a for a in release.get('assets') or list() if a['name'] == asset_name), None)
+    if asset is None:
+        raise Exception(f"No {asset_name} binary found in release {release.get('tag_name')} of {GO2RTC_REPO}")
+    digest = asset.get('digest') or ''
+    return release['tag_name'], asset['browser_download_url'], digest.split(':', 1)[1] if ':' in digest else None
+
+
+def _mirror_file(url: str) -> Optional[str]:
+    try:
+        response = _github.request('GET', url)
+        if response.status_code == 200 and response.text.strip():
+            return response.text.split()[0]
+    except requests.RequestException:
+        pass
+    return None
 
 
-def find_in_path(filename: str, matchFunc=os.path.isfile) -> str:
+def _mirror_release(mirror: str, asset_name: str) -> tuple:
     """
-    Finds a file in the system path, set via the PATH environment variable.
+    Returns the version, download URL and SHA-256 digest of the go2rtc binary on a local mirror,
+    which is expected to serve `<asset>` and, optionally, `<asset>.sha256` and a `version` file
+    from its base URL. Without a version file, the digest stands in for one so that each binary
+    still gets its own cache directory.
     """
-    sys.path.insert(0, '/usr/local/bin')
-    for dirname in sys.path:
-        candidate = os.path.join(dirname, filename)
-        if matchFunc(candidate):
-            return candidate
+    base = mirror.rstrip('/')
+    url = f"{base}/{asset_name}"
+    digest = _mirror_file(url + '.sha256')
+    digest = digest.lower() if digest else None
+    version = _mirror_file(f"{base}/version")
+    if not version:
+        version = f"mirror-{digest[:12]}" if digest else 'mirror'
+    return version, url, digest
+
+
+def _load_cached() -> Optional[dict]:
+    """
+    Returns the binary we downloaded last time, if it is still there and its SHA-256 digest still
+    matches the one recorded when it was downloaded.
+    """
+    try:
+        with open(os.path.join(_cache_dir(), 'current.json'), 'r') as f:
+            current = json.load(f)
+        if os.path.getsize(current['path']) != current['size'] or not os.access(current['path'], os.X_OK):
+            return None
+        if _sha256(current['path']) != current['sha256']:
+            log.warning(f"Cached go2rtc {current['version']} doesn't match its recorded checksum, downloading it again")
+            return None
+        return current
+    except (IOError, OSError, ValueError, KeyError):
+        pass
     return None
 
 
-def find_or_download() -> str:
+def _prune_cache(keep: str) -> None:
+    cache = _cache_dir()
+    for name in os.listdir(cache):
+        path = os.path.join(cache, name)
+        if os.path.isdir(path) and name != keep:
+            log.debug(f"Removing old go2rtc download {path}")
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def download_go2rtc(mirror: str = None) -> str:
+    """
+    Downloads go2rtc for our platform into the persistent cache, either the latest release from
+    Github or the copy on a local mirror, checks its SHA-256 digest when one is published, and
+    makes it the binary used from now on.
+    """
+    asset_name = go2rtc_asset_name()
+    version, url, digest = _mirror_release(mirror, asset_name) if mirror else _latest_release(asset_name)
+    version_dir = os.path.join(_cache_dir(), re.sub(r'[^\w.-]', '_', version))
+    os.makedirs(version_dir, exist_ok=True)
+    path = os.path.join(version_dir, asset_name)
+    log.info(f"Downloading go2rtc {version} ({asset_name}) from {url}")
+    _download(url, path)
+    actual = _sha256(path)
+    if digest and actual != digest:
+        os.unlink(path)
+        raise Exception(f"Checksum mismatch for {asset_name}: expected {digest}, got {actual}")
+    if not digest:
+        log.warning(f"No checksum published for {asset_name}, recording {actual} for future checks")
+    os.chmod(path, 0o755)
+    atomic_write_json(os.path.join(_cache_dir(), 'current.json'),
+                      {'version': version, 'path': path, 'size': os.path.getsize(path), 'sha256': actual})
+    _prune_cache(os.path.basename(version_dir))
+    return path
+
+
+def find_in_path(filename: str) -> str:
+    """
+    Finds an executable in the system path, set via the PATH environment variable.
+    """
+    path = os.environ.get('PATH', os.defpath)
+    if '/usr/local/bin' not in path.split(os.pathsep):
+        path += os.pathsep + '/usr/local/bin'
+    return shutil.which(filename, path=path)
+
+
+def find_or_download(mirror: str = None) -> str:
+    """
+    Finds go2rtc on the system path or in our download cache, downloading it only if neither has it.
+    """
     log.info("Searching for go2rtc binary in system path")
-    log.debug(f"Searching for go2rtc in {sys.path}")
     go2rtc_path = find_in_path('go2rtc')
     if not go2rtc_path:
-        log.warning("go2rtc not found in system path, downloading a fresh copy")
-        go2rtc_path = download_go2rtc()
+        cached = _load_cached()
+        if cached:
+            log.info(f"Using cached go2rtc {cached['version']}")
+            go2rtc_path = cached['path']
+        else:
+            log.warning("go2rtc not found in system path or cache, downloading a fresh copy")
+            go2rtc_path = download_go2rtc(mirror)
     log.info(f"Found go2rtc in {go2rtc_path}")
     return go2rtc_path
+
+
+def echo_source(api_port: int, cam_id: str) -> str:
+    """
+    Builds the go2rtc echo source that asks our resolver for a camera's KVS endpoint.
+    """
+    return f"echo:wget -qO- http://127.0.0.1:{api_port}/stream/{quote(cam_id, safe='')}"
+
+
+def _api_url(port: int, uri: str) -> str:
+    return f"http://127.0.0.1:{port}{uri}"
+
+
+def wait_for_api(port: int, timeout: float = const.GO2RTC_STARTUP_TIMEOUT, stop: Event = None) -> bool:
+    """
+    Waits for go2rtc's REST API to start answering requests, or for `stop` to be set.
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(_api_url(port, '/api'), timeout=1).raise_for_status()
+            return True
+        except requests.RequestException:
+            if stop is not None and stop.is_set():
+                return False
+            time.sleep(0.1)
+    log.error(f"go2rtc API did not come up on port {port} within {timeout} seconds")
+    return False
+
+
+def get_streams(port: int) -> dict:
+    response = requests.get(_api_url(port, '/api/streams'), timeout=5)
+    response.raise_for_status()
+    return response.json()
+
+
+def add_stream(port: int, name: str, src: str) -> None:
+    log.debug(f"Adding stream {name} to go2rtc")
+    response = requests.put(_api_url(port, '/api/streams'), params={'name': name, 'src': src}, timeout=5)
+    response.raise_for_status()
+
+
+def remove_stream(port: int, name: str) -> None:
+    log.debug(f"Removing stream {name} from go2rtc")
+    response = requests.delete(_api_url(port, '/api/streams'), params={'src': name}, timeout=5)
+    response.raise_for_status()
+
+
+def open_stream(port: int, name: str) -> requests.Response:
+    """
+    Connects to a stream as a consumer, which makes go2rtc start its producer if it isn't running.
+    """
+    response = requests.get(_api_url(port, '/api/stream.mp4'), params={'src': name}, stream=True,
+                            timeout=(5, const.WARM_READ_TIMEOUT))
+    response.raise_for_status()
+    return response
+
+
+def get_frame(port: int, name: str) -> bytes:
+    """
+    Gets a single JPEG frame from a stream, starting its producer if it isn't already running.
+    """
+    response = requests.get(_api_url(port, '/api/frame.jpeg'), params={'src': name},
+                            timeout=(5, const.SNAPSHOT_CAPTURE_TIMEOUT))
+    response.raise_for_status()
+    return response.content
+
+
+def start_go2rtc(bin_path, config_path) -> subprocess.Popen:
+    log.info("Starting go2rtc...")
+    if metrics.GO2RTC_STARTED.value():
+        metrics.GO2RTC_RESTARTS_TOTAL.inc()
+    metrics.GO2RTC_STARTED.set(time.time())
+    return subprocess.Popen([bin_path, '-config', config_path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+
+def _log_go2rtc_record(record: str) -> None:
+    try:
+        _, severity, message = record.split(' ', maxsplit=2)
+    except ValueError:
+        go2rtc_log.info(record)
+        return
+    level = GO2RTC_LEVELS.get(severity.encode())
+    if level is None:
+        go2rtc_log.info(record)
+    else:
+        go2rtc_log.log(level, message)
+
+
+def pump_go2rtc_logs(p: subprocess.Popen) -> None:
+    """
+    Copies go2rtc's output into our log until it exits. Each record starts with a timestamp and
+    may continue over several lines. Records below our log level are skipped as soon as we've
+    seen their severity, before any decoding or formatting.
+    """
+    ansi_escape = re.compile(rb'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
+    buf = None
+    skipping = False
+    for line in p.stdout:
+        if b'\x1b' in line:
+            line = ansi_escape.sub(b'', line)
+        line = line.strip()
+        if not line:
+            continue
+        if line[:1].isdigit():
+            if buf is not None:
+                _log_go2rtc_record(buf)
+                buf = None
+            parts = line.split(b' ', 2)
+            level = GO2RTC_LEVELS.get(parts[1]) if len(parts) > 1 else None
+            skipping = level is not None and not go2rtc_log.isEnabledFor(level)
+            if not skipping:
+                buf = line.decode('utf-8', 'replace')
+        elif not skipping:
+            line = line.decode('utf-8', 'replace')
+            buf = line if buf is None else f"{buf}\n{line}"
+    if buf is not None:
+        _log_go2rtc_record(buf)
+    p.wait()
+    if p.returncode:
+        log.warning(f"Exit code from go2rtc is {p.returncode}")
+    else:
+        log.info("go2rtc exited normally")
+
+
+class Go2rtcSupervisor:
+    """
+    Runs go2rtc and keeps it running. go2rtc is restarted if it exits, or if its API stops
+    answering for long enough that it's probably hung, with a growing delay between restarts if it
+    keeps failing. Each restart asks `write_config` for a fresh config file, so go2rtc comes back
+    with the cameras we know about now rather than the ones it started with, and the rest of the
+    add-on (Abode login, discovery, the resolver) carries on undisturbed.
+    """
+    def __init__(self, bin_path: str, write_config: Callable[[], str], api_port: int) -> None:
+        self._bin_path = bin_path
+        self._write_config = write_config
+        self._api_port = api_port
+        self._proc = None
+        self._pump = None
+        self._started = 0
+        self._up = False
+        self._failures = 0
+        self._lock = Lock()
+        self._stop = Event()
+        self._stopped = Event()
+
+    @property
+    def api_port(self) -> int:
+        return self._api_port
+
+    def _spawn(self, config_path: str = None) -> None:
+        self._proc = start_go2rtc(self._bin_path, config_path or self._write_config())
+        self._pump = Thread(target=pump_go2rtc_logs, args=(self._proc,), name='go2rtc-logs', daemon=True)
+        self._pump.start()
+        self._started = time.monotonic()
+        self._up = False
+
+    def _kill(self) -> None:
+        if self._proc.poll() is None:
+            self._proc.terminate()
+            try:
+                self._proc.wait(const.GO2RTC_STOP_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                log.warning("go2rtc didn't stop when asked, killing it")
+                self._proc.kill()
+        self._pump.join()
+
+    def _is_healthy(self) -> bool:
+        try:
+            requests.get(_api_url(self._api_port, '/api'), timeout=const.GO2RTC_HEALTH_TIMEOUT).raise_for_status()
+            return True
+        except requests.RequestException:
+            return False
+
+    def _restarted(self) -> None:
+        if wait_for_api(self._api_port, stop=self._stop):
+            log.info("go2rtc is running again")
+
+    def _recover(self, pump: Thread, reason: str) -> None:
+        with self._lock:
+            if pump is not self._pump:
+                # restart() has already replaced it
+                return
+            if time.monotonic() - self._started > const.GO2RTC_STABLE_AFTER:
+                self._failures = 0
+            delay = min(const.GO2RTC_RESTART_MIN * 2 ** self._failures, const.GO2RTC_RESTART_MAX)
+            self._failures += 1
+            log.warning(f"go2rtc {reason}, restarting it in {delay} seconds")
+            self._kill()
+        while True:
+            if self._stop.wait(delay):
+                return
+            with self._lock:
+                if pump is not self._pump:
+                    return
+                try:
+                    self._spawn()
+                    break
+                except Exception as exc:
+                    # A missing binary, a full disk or a port in use; keep trying rather than give up
+                    delay = min(delay * 2, const.GO2RTC_RESTART_MAX)
+                    self._failures += 1
+                    log.error(f"Unable to start go2rtc ({exc}), trying again in {delay} seconds")
+        self._restarted()
+
+    def _monitor(self) -> None:
+        try:
+            self._supervise()
+        except Exception as exc:
+            log.error("go2rtc supervisor failed, shutting down", exc_info=exc)
+        finally:
+            with self._lock:
+                self._kill()
+            self._stopped.set()
+
+    def _supervise(self) -> None:
+        unhealthy = 0
+        while not self._stop.is_set():
+            pump, proc = self._pump, self._proc
+            pump.join(const.GO2RTC_HEALTH_INTERVAL)
+            if self._stop.is_set():
+                break
+            if not pump.is_alive():
+                unhealthy = 0
+                self._recover(pump, f"exited with code {proc.wait()}")
+            elif self._is_healthy():
+                self._up = True
+                unhealthy = 0
+            elif not self._up and time.monotonic() - self._started < const.GO2RTC_STARTUP_TIMEOUT:
+                # Still starting up
+                pass
+            else:
+                unhealthy += 1
+                metrics.GO2RTC_HEALTH_FAILURES_TOTAL.inc()
+                if unhealthy >= const.GO2RTC_HEALTH_FAILURES:
+                    unhealthy = 0
+                    self._recover(pump, f"hasn't answered for {const.GO2RTC_HEALTH_FAILURES} health checks")
+
+    def start(self, config_path: str = None) -> None:
+        self._spawn(config_path)
+        Thread(target=self._monitor, name='go2rtc-supervisor', daemon=True).start()
+
+    def restart(self, config_path: str = None, api_port: int = None) -> None:
+        """
+        Restarts go2rtc straight away, such as when its ports have changed.
+        """
+        with self._lock:
+            self._kill()
+            if api_port:
+                self._api_port = api_port
+            self._spawn(config_path)
+
+    def stop(self) -> None:
+        """
+        Asks go2rtc to exit straight away. The monitor notices as soon as its output closes and
+        finishes shutting down, so `wait()` returns within go2rtc's own shutdown time.
+        """
+        self._stop.set()
+        proc = self._proc
+        if proc is not None and proc.poll() is None:
+            proc.terminate()
+
+    def wait(self) -> None:
+        """
+        Blocks until the supervisor has been stopped, or has failed, and go2rtc has exited.
+        """
+        while not self._stopped.wait(1):
+            pass
@@ -1,8 +1,8 @@
+import json
 from urllib.parse import urljoin
 
-import requests
-
 from logger import log
+from transport import Transport
 from utils import obscure_passwords
 from const import DEFAULT_PORTS, DEFAULT_SUPERVISOR_URL
 
@@ -12,7 +12,7 @@ class HassApiClient:
         self.token = token
         self.url = supervisor_url
         self.has_api = False
-        self._http = requests.Session()
+        self._http = Transport('Supervisor')
         self._get_token()
 
     def _get_token(self) -> None:
@@ -27,11 +27,11 @@ class HassApiClient:
         else:
             log.warning("Unable to get HA supervisor token")
 
-    def _request(self, method: str, uri: str, data=None, raise_for_status=True):
+    def _request(self, method: str, uri: str, data=None, raise_for_status=True, quiet=False):
         if not self.has_api:
             return None
         method = method.upper()
-        log.info(f"Calling Home Assistant API: {method} {uri}")
+        (log.debug if quiet else log.info)(f"Calling Home Assistant API: {method} {uri}")
         log.debug(f"Full URL: {urljoin(self.url, uri)}")
         log.debug(f"Headers:  {obscure_passwords(self._http.headers)}")
         log.debug(f"Data:     {data}")
@@ -55,21 +55,13 @@ class HassApiClient:
         log.info("Getting current state of entities")
         return self._request('GET', '/core/api/states')
 
-    def get_abode_cams(self) -> list:
-        def __is_abode_cam(state) -> bool:
-            if not state['entity_id'].startswith('camera.'):
-                return False
-            elif 'device_id' not in state['attributes']:
-                return False
-            elif not state['attributes']['device_id'].startswith('XF:'):
-                return False
-            elif 'device_type' not in state['attributes']:
-                return False
-            elif not state['attributes']['device_type'].startswith('Abode Cam'):
-                return False
-            return True
-        states = self.get_states()
-        return [s for s in states if __is_abode_cam(s)]
+    def set_state(self, entity_id: str, state, attributes: dict = None) -> dict:
+        """
+        Creates or updates an entity that only lives in Home Assistant's state machine. It is gone
+        after Home Assistant restarts, until we set it again.
+        """
+        return self._request('POST', f'/core/api/states/{entity_id}',
+                             data=json.dumps({'state': state, 'attributes': attributes or dict()}), quiet=True)
 
     def get_addon_config(self) -> dict:
         return self._request('GET', '/addons/self/info')
@@ -0,0 +1,306 @@
+import json
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from itertools import count
+from queue import Queue
+from threading import Event, Lock, Thread
+from typing import Callable, Dict, List
+
+import websocket
+
+import const
+from logger import log
+
+
+_RECONNECTED = '__reconnected__'
+
+
+class HassWebSocketError(Exception):
+    pass
+
+
+class HassWebSocket:
+    """
+    A small client for Home Assistant's WebSocket API, reached through the Supervisor proxy.
+    Commands can be sent from any thread. Event callbacks run one at a time on a separate
+    dispatcher thread, so they can send commands of their own. If the connection drops it is
+    re-established with backoff, subscriptions are renewed and the reconnect callbacks are called
+    so that listeners can catch up on anything they missed.
+    """
+    def __init__(self, token: str, supervisor_url: str = const.DEFAULT_SUPERVISOR_URL) -> None:
+        self.token = token
+        self.url = supervisor_url.replace('http', 'ws', 1).rstrip('/') + '/core/websocket'
+        self._ws = None
+        self._ids = count(1)
+        self._send_lock = Lock()
+        self._pending: Dict[int, Future] = dict()
+        self._subscriptions: Dict[int, str] = dict()
+        self._requests: Dict[str, dict] = dict()
+        self._handlers: Dict[str, List[Callable[[dict], None]]] = dict()
+        self._reconnect_handlers: List[Callable[[], None]] = list()
+        self._events = Queue()
+        self._connected = Event()
+        self._stop = Event()
+
+    def _connect(self) -> None:
+        ws = websocket.create_connection(self.url, timeout=const.HASS_WS_TIMEOUT)
+        message = json.loads(ws.recv())
+        if message.get('type') != 'auth_required':
+            raise HassWebSocketError(f"Unexpected message from Home Assistant: {message}")
+        ws.send(json.dumps({'type': 'auth', 'access_token': self.token}))
+        message = json.loads(ws.recv())
+        if message.get('type') != 'auth_ok':
+            raise HassWebSocketError(f"Home Assistant rejected our token: {message.get('message')}")
+        ws.settimeout(None)
+        self._ws = ws
+        self._ids = count(1)
+        self._connected.set()
+        log.info(f"Connected to Home Assistant WebSocket API (version {message.get('ha_version')})")
+
+    def _read(self) -> None:
+        while True:
+            try:
+                message = json.loads(self._ws.recv())
+            except (websocket.WebSocketException, OSError, ValueError) as exc:
+                if not self._stop.is_set():
+                    log.warning(f"Lost connection to Home Assistant WebSocket API: {exc}")
+                break
+            if message.get('type') == 'event':
+                event_type = self._subscriptions.get(message.get('id'))
+                if event_type:
+                    self._events.put((event_type, message['event']))
+            elif message.get('type') == 'result':
+                future = self._pending.pop(message.get('id'), None)
+                if future is None:
+                    continue
+                if message.get('success'):
+                    future.set_result(message.get('result'))
+                else:
+                    error = message.get('error') or dict()
+                    future.set_exception(HassWebSocketError(f"{error.get('code')}: {error.get('message')}"))
+        with self._send_lock:
+            self._connected.clear()
+            pending, self._pending = self._pending, dict()
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(HassWebSocketError("Connection to Home Assistant was lost"))
+
+    def _dispatch(self) -> None:
+        while True:
+            event_type, event = self._events.get()
+            if event_type is None:
+                return
+            if event_type == _RECONNECTED:
+                for handler in self._reconnect_handlers:
+                    try:
+                        handler()
+                    except Exception as exc:
+                        log.error("Error catching up after reconnecting to Home Assistant", exc_info=exc)
+                continue
+            for handler in self._handlers.get(event_type, list()):
+                try:
+                    handler(event)
+                except Exception as exc:
+                    log.error(f"Error handling Home Assistant {event_type} event", exc_info=exc)
+
+    def _subscribe_all(self) -> None:
+        self._subscriptions.clear()
+        for name, request in self._requests.items():
+            self._subscriptions[self._send(request)] = name
+
+    def _run(self) -> None:
+        backoff = const.HASS_WS_BACKOFF_MIN
+        first = True
+        while not self._stop.is_set():
+            if not first:
+                try:
+                    self._connect()
+                    self._subscribe_all()
+                    backoff = const.HASS_WS_BACKOFF_MIN
+                    self._events.put((_RECONNECTED, None))
+                except (websocket.WebSocketException, OSError, ValueError, HassWebSocketError) as exc:
+                    log.warning(f"Unable to reconnect to Home Assistant WebSocket API: {exc}, "
+                                f"retrying in {backoff} seconds")
+                    self._stop.wait(backoff)
+                    backoff = min(backoff * 2, const.HASS_WS_BACKOFF_MAX)
+                    continue
+            first = False
+            self._read()
+
+    def _send(self, message: dict) -> int:
+        with self._send_lock:
+            msg_id = next(self._ids)
+            self._ws.send(json.dumps(dict(id=msg_id, **message)))
+            return msg_id
+
+    def call(self, command: str, **kwargs):
+        """
+        Sends a command and waits for its result.
+        """
+        if not self._connected.wait(const.HASS_WS_TIMEOUT):
+            raise HassWebSocketError("Not connected to Home Assistant")
+        future = Future()
+        with self._send_lock:
+            if not self._connected.is_set():
+                raise HassWebSocketError("Not connected to Home Assistant")
+            # Home Assistant wants ids in the order they are sent, so both happen under the lock
+            msg_id = next(self._ids)
+            self._pending[msg_id] = future
+            try:
+                self._ws.send(json.dumps(dict(id=msg_id, type=command, **kwargs)))
+            except (websocket.WebSocketException, OSError) as exc:
+                self._pending.pop(msg_id, None)
+                raise HassWebSocketError(f"Unable to send {command} to Home Assistant: {exc}")
+        try:
+            return future.result(const.HASS_WS_TIMEOUT)
+        except FutureTimeoutError:
+            raise HassWebSocketError(f"Home Assistant didn't answer {command} in {const.HASS_WS_TIMEOUT} seconds")
+        finally:
+            self._pending.pop(msg_id, None)
+
+    def _subscribe(self, name: str, request: dict, handler: Callable[[dict], None]) -> None:
+        first = name not in self._requests
+        self._requests.setdefault(name, request)
+        self._handlers.setdefault(name, list()).append(handler)
+        if first and self._connected.is_set():
+            self._subscriptions[self._send(request)] = name
+
+    def subscribe(self, event_type: str, handler: Callable[[dict], None]) -> None:
+        self._subscribe(event_type, {'type': 'subscribe_events', 'event_type': event_type}, handler)
+
+    def subscribe_trigger(self, name: str, trigger: list, handler: Callable[[dict], None]) -> None:
+        """
+        Subscribes to an automation trigger, so that Home Assistant only sends us the state
+        changes we care about. The handler is given the trigger variables each time it fires.
+        """
+        self._subscribe(name, {'type': 'subscribe_trigger', 'trigger': trigger},
+                        lambda event: handler((event.get('variables') or dict()).get('trigger') or dict()))
+
+    def on_reconnect(self, handler: Callable[[], None]) -> None:
+        self._reconnect_handlers.append(handler)
+
+    def start(self) -> None:
+        """
+        Connects and authenticates, then hands the connection over to background threads.
+        """
+        self._connect()
+        Thread(target=self._dispatch, name='hass-ws-events', daemon=True).start()
+        Thread(target=self._run, name='hass-ws', daemon=True).start()
+
+    def close(self) -> None:
+        self._stop.set()
+        self._events.put((None, None))
+        if self._ws:
+            self._ws.close()
+
+
+class AbodeCameraDiscovery:
+    """
+    Finds the Home Assistant camera entity for each Abode camera using the entity and device
+    registries, rather than the state of every entity in the house, and keeps the mapping up to
+    date as entities are added, renamed or removed.
+    """
+    def __init__(self, ws: HassWebSocket) -> None:
+        self._ws = ws
+        self._entities: Dict[str, str] = dict()   # camera entity id -> HA device id
+        self._devices: Dict[str, str] = dict()    # HA device id -> Abode device id
+        self._listeners: List[Callable[[dict], None]] = list()
+        self._lock = Lock()
+
+    @property
+    def ws(self) -> HassWebSocket:
+        return self._ws
+
+    @staticmethod
+    def _abode_id(device: dict) -> str:
+        for domain, identifier in device.get('identifiers') or list():
+            if domain == 'abode' and identifier.startswith('XF:'):
+                return identifier
+        return None
+
+    @staticmethod
+    def _is_abode_camera(entry: dict) -> bool:
+        return entry.get('platform') == 'abode' and entry.get('entity_id', '').startswith('camera.')
+
+    def _load_devices(self) -> Dict[str, str]:
+        devices = self._ws.call('config/device_registry/list')
+        return {d['id']: self._abode_id(d) for d in devices if self._abode_id(d)}
+
+    def _load(self) -> None:
+        entities = self._ws.call('config/entity_registry/list')
+        devices = self._load_devices()
+        with self._lock:
+            self._entities = {e['entity_id']: e.get('device_id') for e in entities if self._is_abode_camera(e)}
+            self._devices = devices
+
+    @property
+    def slugs(self) -> dict:
+        """
+        Returns the go2rtc slug (the entity id without `camera.`) for each Abode device id.
+        """
+        with self._lock:
+            return {self._devices[device_id]: entity_id.replace('camera.', '', 1)
+                    for entity_id, device_id in self._entities.items() if device_id in self._devices}
+
+    def add_listener(self, listener: Callable[[dict], None]) -> None:
+        self._listeners.append(listener)
+
+    def _changed(self, before: dict) -> None:
+        after = self.slugs
+        if after == before:
+            return
+        log.info("Abode cameras have changed in Home Assistant")
+        for listener in self._listeners:
+            listener(after)
+
+    def _on_entity_event(self, event: dict) -> None:
+        data = event.get('data') or dict()
+        entity_id = data.get('entity_id', '')
+        old_entity_id = (data.get('changes') or dict()).get('entity_id') or data.get('old_entity_id')
+        if not entity_id.startswith('camera.') and not (old_entity_id or '').startswith('camera.'):
+            return
+        before = self.slugs
+        with self._lock:
+            self._entities.pop(entity_id, None)
+            if old_entity_id:
+                self._entities.pop(old_entity_id, None)
+        if data.get('action') != 'remove':
+            entry = self._ws.call('config/entity_registry/get', entity_id=entity_id)
+            if self._is_abode_camera(entry):
+                with self._lock:
+                    self._entities[entity_id] = entry.get('device_id')
+                if entry.get('device_id') not in self._devices:
+                    devices = self._load_devices()
+                    with self._lock:
+                        self._devices = devices
+        self._changed(before)
+
+    def _on_device_event(self, event: dict) -> None:
+        # Every device in the house fires these; only new devices and ones we know matter
+        data = event.get('data') or dict()
+        device_id = data.get('device_id')
+        with self._lock:
+            known = device_id in self._devices
+        if not known and data.get('action') != 'create':
+            return
+        before = self.slugs
+        if data.get('action') == 'remove':
+            with self._lock:
+                self._devices.pop(device_id, None)
+            self._changed(before)
+            return
+        devices = self._load_devices()
+        with self._lock:
+            self._devices = devices
+        self._changed(before)
+
+    def _on_reconnect(self) -> None:
+        before = self.slugs
+        self._load()
+        self._changed(before)
+
+    def start(self) -> dict:
+        self._load()
+        self._ws.subscribe('entity_registry_updated', self._on_entity_event)
+        self._ws.subscribe('device_registry_updated', self._on_device_event)
+        self._ws.on_reconnect(self._on_reconnect)
+        return self.slugs
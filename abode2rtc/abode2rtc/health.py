@@ -0,0 +1,153 @@
+import time
+from datetime import datetime, timezone
+from threading import Event, Lock, Thread
+from typing import Dict, Optional
+
+import requests
+
+import const
+import go2rtc
+import metrics
+from abode_events import is_offline
+from accounts import AbodeAccounts
+from hass import HassApiClient
+from logger import log
+
+
+def _timestamp(ts: Optional[float]) -> str:
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat(timespec='seconds') if ts else 'unknown'
+
+
+class StreamHealth:
+    """
+    Publishes how each camera's stream is doing as entities in Home Assistant: how long the last
+    stream took to set up, whether the camera is online, how many viewers go2rtc has for it, when
+    it last streamed and when its account's access token was issued. Events only update what we
+    know; every `interval` seconds the entities that changed since then are sent, one call each,
+    so a busy dashboard doesn't turn into a call per viewer. Entities set this way are forgotten
+    when Home Assistant restarts, so everything is sent again every so often.
+    """
+    def __init__(self, hass: HassApiClient, go2rtc_port: int, accounts: AbodeAccounts,
+                 interval: float = const.HEALTH_PUBLISH_INTERVAL) -> None:
+        self._hass = hass
+        self._go2rtc_port = go2rtc_port
+        self._accounts = accounts
+        self._interval = interval
+        self._latency: Dict[str, float] = dict()
+        self._last_result: Dict[str, str] = dict()
+        self._last_stream: Dict[str, float] = dict()
+        self._online: Dict[str, bool] = dict()
+        self._viewers: Dict[str, int] = dict()
+        self._published: Dict[str, tuple] = dict()
+        self._last_full = 0.0
+        self._lock = Lock()
+        self._stop = Event()
+
+    def resolved(self, cam_id: str, result: str, seconds: float) -> None:
+        """
+        Result listener for the resolver.
+        """
+        with self._lock:
+            self._last_result[cam_id] = result
+            if result in ('cached', 'fetched'):
+                self._latency[cam_id] = seconds
+                self._last_stream[cam_id] = time.time()
+                self._online[cam_id] = True
+            elif result == 'offline':
+                self._online[cam_id] = False
+
+    def camera_status(self, cam_id: str, online: bool) -> None:
+        """
+        Status listener for the Abode event feed.
+        """
+        with self._lock:
+            self._online[cam_id] = online
+
+    def _count_viewers(self) -> None:
+        try:
+            streams = go2rtc.get_streams(self._go2rtc_port) or dict()
+        except requests.RequestException as exc:
+            log.debug(f"Unable to get stream list from go2rtc, keeping the last viewer counts: {exc}")
+            return
+        self._viewers = {slug: len((info or dict()).get('consumers') or list()) for slug, info in streams.items()}
+
+    def _entities(self) -> Dict[str, tuple]:
+        # Copied under the lock so the resolver never waits for us; everything else is local
+        with self._lock:
+            latencies, results = dict(self._latency), dict(self._last_result)
+            last_streams, online = dict(self._last_stream), dict(self._online)
+        entities = dict()
+        for account in self._accounts.ready:
+            client = account.client
+            slugs = client.cameras.slugs
+            offline = {d['id'] for d in client.cached_devices if is_offline(d)}
+            token_issued = _timestamp(client.token_issued)
+            for cam in client.cameras:
+                slug = slugs.get(cam.id)
+                if not slug:
+                    continue
+                common = {'camera_id': cam.id, 'abode_account': account.name or None}
+                latency = latencies.get(cam.id)
+                entities[f"sensor.{slug}_stream_latency"] = (
+                    'unknown' if latency is None else round(latency, 3),
+                    dict(common, friendly_name=f"{cam.name} stream latency", unit_of_measurement='s',
+                         device_class='duration', state_class='measurement',
+                         last_result=results.get(cam.id)))
+                entities[f"binary_sensor.{slug}_stream_online"] = (
+                    'on' if online.get(cam.id, cam.id not in offline) else 'off',
+                    dict(common, friendly_name=f"{cam.name} online", device_class='connectivity'))
+                entities[f"sensor.{slug}_stream_viewers"] = (
+                    self._viewers.get(slug, 0),
+                    dict(common, friendly_name=f"{cam.name} viewers", state_class='measurement', icon='mdi:eye'))
+                entities[f"sensor.{slug}_last_stream"] = (
+                    _timestamp(last_streams.get(cam.id)),
+                    dict(common, friendly_name=f"{cam.name} last stream", device_class='timestamp'))
+                entities[f"sensor.{slug}_abode_token_issued"] = (
+                    token_issued,
+                    dict(common, friendly_name=f"{cam.name} Abode token issued", device_class='timestamp',
+                         icon='mdi:key'))
+        return entities
+
+    def publish(self) -> int:
+        """
+        Sends the entities that changed since they were last sent, or all of them if it's time
+        for a full refresh. Returns how many were sent.
+        """
+        self._count_viewers()
+        entities = self._entities()
+        full = time.monotonic() - self._last_full > const.HEALTH_REFRESH_INTERVAL
+        sent = 0
+        for entity_id, value in entities.items():
+            if not full and self._published.get(entity_id) == value:
+                continue
+            try:
+                self._hass.set_state(entity_id, *value)
+            except requests.RequestException as exc:
+                # Home Assistant is probably down or restarting; whatever is left goes next time
+                log.warning(f"Unable to update {entity_id} in Home Assistant: {exc}")
+                metrics.HEALTH_UPDATES_TOTAL.inc('error')
+                return sent
+            self._published[entity_id] = value
+            metrics.HEALTH_UPDATES_TOTAL.inc('ok')
+            sent += 1
+        if full:
+            self._last_full = time.monotonic()
+        if sent:
+            log.debug(f"Updated {sent} stream health entities in Home Assistant")
+        return sent
+
+    def _run(self) -> None:
+        while True:
+            try:
+                self.publish()
+            except Exception as exc:
+                log.error("Error publishing stream health to Home Assistant", exc_info=exc)
+            if self._stop.wait(self._interval):
+                return
+
+    def start(self) -> None:
+        log.info(f"Publishing stream health to Home Assistant every {self._interval:.0f} seconds")
+        Thread(target=self._run, name='stream-health', daemon=True).start()
+
+    def stop(self) -> None:
+        self._stop.set()
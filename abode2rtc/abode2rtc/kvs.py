@@ -1,7 +1,10 @@
+import calendar
 import json
+import time
 from urllib.parse import parse_qs, urlparse
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 
+import const
 from logger import log
 
 
@@ -12,6 +15,43 @@ class KVSEndpointData:
     channel_id: str
     client_id: str
     ice_servers: str
+    expires: float = 0
+    fetched_at: float = field(default_factory=time.time)
+
+    def expires_within(self, seconds: float) -> bool:
+        return self.expires - time.time() <= seconds
+
+    def needs_refresh(self) -> bool:
+        # Short-lived endpoints get refreshed at half-life so we don't prefetch them in a loop
+        return self.expires_within(min(const.KVS_PREFETCH_MARGIN, (self.expires - self.fetched_at) / 2))
+
+    def to_go2rtc_source(self) -> str:
+        """
+        Formats the endpoint as a go2rtc `webrtc:` source string, as printed by the echo source.
+        """
+        return (f"webrtc:{self.endpoint_url}"
+                "#format=kinesis"
+                f"#client_id={self.client_id}"
+                f"#ice_servers={self.ice_servers}")
+
+
+def _signature_expiry(endpoint_qs: dict) -> float:
+    """
+    Works out when a SigV4-signed endpoint stops being valid, from its X-Amz-Date and
+    X-Amz-Expires query parameters.
+    """
+    try:
+        signed_at = time.strptime(endpoint_qs['X-Amz-Date'][0], '%Y%m%dT%H%M%SZ')
+        return calendar.timegm(signed_at) + int(endpoint_qs['X-Amz-Expires'][0])
+    except (KeyError, ValueError):
+        return time.time() + const.KVS_DEFAULT_TTL
+
+
+def _ice_servers_expiry(ice_servers: list) -> float:
+    ttls = [int(s['ttl']) for s in ice_servers if isinstance(s, dict) and 'ttl' in s]
+    if not ttls:
+        return float('inf')
+    return time.time() + min(ttls)
 
 
 def parse_kvs_response(data: dict, cam_name: str) -> KVSEndpointData:
@@ -32,5 +72,6 @@ def parse_kvs_response(data: dict, cam_name: str) -> KVSEndpointData:
     channel_id = channel_parts[1]
     client_id = channel_parts[2]
     ice_servers = json.dumps(data['iceServers'])
+    expires = min(_signature_expiry(endpoint_qs), _ice_servers_expiry(data['iceServers']))
 
-    return KVSEndpointData(endpoint, channel_arn, channel_id, client_id, ice_servers)
+    return KVSEndpointData(endpoint, channel_arn, channel_id, client_id, ice_servers, expires)
@@ -1,14 +1,38 @@
+import atexit
 from logging import Logger
-from colorlog import StreamHandler, ColoredFormatter, getLogger, INFO, DEBUG  # noqa: F401
+from logging.handlers import QueueHandler, QueueListener
+from queue import Full, Queue
+from colorlog import StreamHandler, ColoredFormatter, getLogger, ERROR, WARNING, INFO, DEBUG  # noqa: F401
+
+LOG_QUEUE_SIZE = 10000
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Hands records to the listener thread without waiting. If the console can't keep up and the
+    queue fills, records are dropped (and counted) rather than stalling whoever is logging.
+    """
+    dropped = 0
+
+    def enqueue(self, record) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except Full:
+            self.dropped += 1
 
 
 handler = StreamHandler()
 handler.setFormatter(ColoredFormatter('%(log_color)s%(asctime)s %(name)s [%(levelname)s] %(message)s'))
 
+queue_handler = DroppingQueueHandler(Queue(maxsize=LOG_QUEUE_SIZE))
+listener = QueueListener(queue_handler.queue, handler)
+listener.start()
+atexit.register(listener.stop)
+
 log: Logger = getLogger("abode2rtc")
 log.setLevel(INFO)
-log.addHandler(handler)
+log.addHandler(queue_handler)
 
 go2rtc_log: Logger = getLogger('go2rtc')
 go2rtc_log.setLevel(INFO)
-go2rtc_log.addHandler(handler)
+go2rtc_log.addHandler(queue_handler)
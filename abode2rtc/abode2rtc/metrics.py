@@ -0,0 +1,190 @@
+import time
+from bisect import bisect_left
+from threading import Lock
+from typing import Callable, Dict, Tuple
+
+from logger import queue_handler
+
+# A few Prometheus-style metrics, served in the text exposition format from the resolver's /metrics
+# endpoint. Updating a metric is a dict lookup and an add under a lock, so they can stay on all the time.
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry: list = list()
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = Lock()
+        _registry.append(self)
+
+    def _header(self) -> list:
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+
+    def render(self) -> list:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[tuple, float] = dict() if labelnames else {(): 0}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> list:
+        with self._lock:
+            values = list(self._values.items())
+        return self._header() + [f"{self.name}{_format_labels(self.labelnames, k)} {v}" for k, v in values]
+
+
+class Gauge(_Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 function: Callable[[], float] = None) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[tuple, float] = dict() if labelnames else {(): 0}
+        self._function = function
+
+    def set(self, value: float, *labels: str) -> None:
+        with self._lock:
+            self._values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def dec(self, *labels: str, amount: float = 1) -> None:
+        self.inc(*labels, amount=-amount)
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0)
+
+    def render(self) -> list:
+        if self._function:
+            value = self._function()
+            return self._header() + ([f"{self.name} {value}"] if value is not None else [])
+        with self._lock:
+            values = list(self._values.items())
+        return self._header() + [f"{self.name}{_format_labels(self.labelnames, k)} {v}" for k, v in values]
+
+
+class Histogram(_Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        # Per label set: [count per bucket (plus +Inf), sum]
+        self._values: Dict[tuple, list] = dict()
+
+    def observe(self, value: float, *labels: str) -> None:
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    def count(self, *labels: str) -> int:
+        entry = self._values.get(labels)
+        return sum(entry[0]) if entry else 0
+
+    def render(self) -> list:
+        with self._lock:
+            values = [(k, list(counts), total) for k, (counts, total) in self._values.items()]
+        lines = self._header()
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float('inf'),), counts):
+                cumulative += n
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                bucket_labels = _format_labels(self.labelnames, labels, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+def render() -> str:
+    lines = list()
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+def _go2rtc_uptime() -> float:
+    started = GO2RTC_STARTED.value()
+    return time.time() - started if started else None
+
+
+ABODE_REQUEST_SECONDS = Histogram('abode2rtc_abode_request_seconds',
+                                  'Time taken by Abode API requests', ('method', 'endpoint'))
+ABODE_LOGIN_SECONDS = Histogram('abode2rtc_abode_login_seconds', 'Time taken to log into Abode')
+ABODE_CLAIMS_SECONDS = Histogram('abode2rtc_abode_claims_seconds', 'Time taken to get an Abode access token')
+KVS_STREAM_SECONDS = Histogram('abode2rtc_kvs_stream_seconds', 'Time taken by Abode to set up a KVS stream')
+RESOLVE_SECONDS = Histogram('abode2rtc_stream_resolve_seconds',
+                            'Time taken to hand go2rtc a stream source, end to end', ('result',))
+HTTP_ATTEMPT_SECONDS = Histogram('abode2rtc_http_attempt_seconds',
+                                 'Time taken by each HTTP attempt, including retries', ('service', 'outcome'))
+HTTP_RETRIES_TOTAL = Counter('abode2rtc_http_retries_total', 'HTTP requests that were retried', ('service',))
+HTTP_CIRCUIT_OPEN = Gauge('abode2rtc_http_circuit_open', 'Whether requests to a service are paused', ('service',))
+HTTP_CIRCUIT_REJECTED_TOTAL = Counter('abode2rtc_http_circuit_rejected_total',
+                                      'Requests failed straight away because a service is down', ('service',))
+ADMISSION_QUEUE_DEPTH = Gauge('abode2rtc_kvs_queue_depth', 'Requests waiting for a slot to set up a KVS session',
+                              ('service',))
+ADMISSION_ACTIVE = Gauge('abode2rtc_kvs_sessions_starting', 'KVS sessions being set up', ('service',))
+ADMISSION_WAIT_SECONDS = Histogram('abode2rtc_kvs_queue_wait_seconds',
+                                   'Time spent waiting for a slot to set up a KVS session', ('service',))
+ADMISSION_REJECTED_TOTAL = Counter('abode2rtc_kvs_queue_rejected_total',
+                                   'Requests turned away because the KVS session queue was full or too slow',
+                                   ('service', 'reason'))
+KVS_REQUESTS_PER_CALL = Histogram('abode2rtc_kvs_stream_requests_per_call',
+                                  'Concurrent requests for a camera served by one KVS stream call',
+                                  buckets=(1, 2, 3, 4, 6, 8, 12, 16, 24, 32))
+WARM_STREAMS = Gauge('abode2rtc_warm_streams', 'Streams being kept connected ahead of viewers')
+WARM_CONNECTS_TOTAL = Counter('abode2rtc_warm_connects_total', 'Times an always-on stream was (re)connected')
+PREROLL_TOTAL = Counter('abode2rtc_preroll_total', 'Motion pre-roll triggers and outcomes', ('result',))
+HEALTH_UPDATES_TOTAL = Counter('abode2rtc_health_updates_total', 'Stream health entities sent to Home Assistant',
+                               ('result',))
+SNAPSHOT_REQUESTS_TOTAL = Counter('abode2rtc_snapshot_requests_total', 'Snapshot requests, by how they were served',
+                                  ('result',))
+SNAPSHOT_CAPTURE_SECONDS = Histogram('abode2rtc_snapshot_capture_seconds', 'Time taken to get a frame from go2rtc')
+SNAPSHOT_REQUESTS_PER_CAPTURE = Histogram('abode2rtc_snapshot_requests_per_capture',
+                                          'Concurrent snapshot requests for a camera served by one capture',
+                                          buckets=(1, 2, 3, 4, 6, 8, 12, 16, 24, 32))
+ABODE_EVENTS_TOTAL = Counter('abode2rtc_abode_events_total', 'Events received from the Abode event feed', ('event',))
+ABODE_EVENTS_CONNECTED = Gauge('abode2rtc_abode_events_connected', 'Whether the Abode event feed is connected',
+                               ('service',))
+CAMERA_OFFLINE_TOTAL = Counter('abode2rtc_camera_offline_total', 'Times Abode reported a camera as offline')
+TOKEN_REFRESH_TOTAL = Counter('abode2rtc_token_refresh_total', 'Times we got a new Abode access token', ('kind',))
+TOKEN_REFRESH_FAILURES_TOTAL = Counter('abode2rtc_token_refresh_failures_total',
+                                       'Background token refreshes that failed and will be retried')
+GO2RTC_RESTARTS_TOTAL = Counter('abode2rtc_go2rtc_restarts_total', 'Times go2rtc has been restarted')
+GO2RTC_HEALTH_FAILURES_TOTAL = Counter('abode2rtc_go2rtc_health_check_failures_total',
+                                       'go2rtc health checks that got no answer')
+GO2RTC_STARTED = Gauge('abode2rtc_go2rtc_start_time_seconds', 'When go2rtc was last started (Unix time)')
+GO2RTC_UPTIME = Gauge('abode2rtc_go2rtc_uptime_seconds', 'How long go2rtc has been running', function=_go2rtc_uptime)
+LOG_RECORDS_DROPPED = Gauge('abode2rtc_log_records_dropped', 'Log records dropped because the log queue was full',
+                            function=lambda: queue_handler.dropped)
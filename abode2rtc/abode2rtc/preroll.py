@@ -0,0 +1,145 @@
+import time
+from collections import deque
+from threading import Event, Lock, Thread
+from typing import Deque, Dict
+
+import requests
+
+import const
+import go2rtc
+import metrics
+from hass_ws import HassWebSocket
+from logger import log
+from warm import StreamKeeper
+
+
+class MotionPreroll:
+    """
+    Starts a camera's stream in go2rtc as soon as one of its motion or doorbell entities in Home
+    Assistant fires, so that it is already connected by the time someone taps the notification.
+    `triggers` maps each entity id (a `binary_sensor` that turns on, or an `event` entity) to the
+    id, name or slug of its camera. A stream nobody has opened within `idle_timeout` seconds is
+    stopped again, and each camera is only started `per_hour` times an hour so that a flapping
+    sensor can't keep starting KVS sessions.
+    """
+    def __init__(self, ws: HassWebSocket, go2rtc_port: int, cameras, triggers: Dict[str, str],
+                 idle_timeout: float = const.PREROLL_IDLE_TIMEOUT,
+                 per_hour: int = const.PREROLL_STARTS_PER_HOUR) -> None:
+        self._ws = ws
+        self._go2rtc_port = go2rtc_port
+        self._cameras = cameras
+        self._triggers = triggers
+        self._idle_timeout = idle_timeout
+        self._per_hour = per_hour
+        self._keepers: Dict[str, StreamKeeper] = dict()
+        self._deadlines: Dict[str, float] = dict()
+        self._starts: Dict[str, Deque[float]] = dict()
+        self._lock = Lock()
+        self._stop = Event()
+
+    def _consumers(self, slug: str) -> int:
+        try:
+            info = (go2rtc.get_streams(self._go2rtc_port) or dict()).get(slug) or dict()
+        except requests.RequestException:
+            return 0
+        return len(info.get('consumers') or list())
+
+    def _allowed(self, cam_id: str) -> bool:
+        now = time.time()
+        starts = self._starts.setdefault(cam_id, deque())
+        while starts and now - starts[0] > 3600:
+            starts.popleft()
+        if len(starts) >= self._per_hour:
+            return False
+        starts.append(now)
+        return True
+
+    def trigger(self, key: str, reason: str = None) -> bool:
+        """
+        Starts the stream of the camera with the given id, name or slug if it isn't streaming
+        already, or gives it another `idle_timeout` seconds if we started it. Returns True if the
+        camera is (still) being pre-rolled.
+        """
+        cam = self._cameras.get(key)
+        slug = self._cameras.slugs.get(cam.id) if cam else None
+        if not slug:
+            log.warning(f"Camera {key} for pre-roll trigger {reason} isn't in go2rtc")
+            return False
+        with self._lock:
+            if self._stop.is_set():
+                return False
+            if cam.id in self._keepers:
+                self._deadlines[cam.id] = time.time() + self._idle_timeout
+                metrics.PREROLL_TOTAL.inc('extended')
+                return True
+        if self._consumers(slug):
+            log.debug(f"Camera {cam.name} is already streaming, no need to pre-roll it")
+            metrics.PREROLL_TOTAL.inc('streaming')
+            return False
+        with self._lock:
+            if cam.id in self._keepers or self._stop.is_set():
+                return cam.id in self._keepers
+            if not self._allowed(cam.id):
+                log.info(f"Not pre-rolling camera {cam.name} for {reason}, it has been started "
+                         f"{self._per_hour} times in the last hour")
+                metrics.PREROLL_TOTAL.inc('rate_limited')
+                return False
+            log.info(f"Pre-rolling camera {cam.name} for {reason}")
+            keeper = self._keepers[cam.id] = StreamKeeper(self._go2rtc_port, cam, slug, kind='pre-roll')
+            self._deadlines[cam.id] = time.time() + self._idle_timeout
+            keeper.start()
+            metrics.PREROLL_TOTAL.inc('started')
+            return True
+
+    def _on_trigger(self, trigger: dict) -> None:
+        entity_id = trigger.get('entity_id')
+        if entity_id in self._triggers:
+            self.trigger(self._triggers[entity_id], entity_id)
+
+    def check(self) -> None:
+        """
+        Stops pre-rolled streams once someone else is watching (go2rtc keeps the stream going for
+        them) or once nobody has opened them in time.
+        """
+        with self._lock:
+            keepers = dict(self._keepers)
+        now = time.time()
+        for cam_id, keeper in keepers.items():
+            if self._consumers(keeper.slug) > 1:
+                outcome, reason = 'watched', "someone is watching it"
+            elif now > self._deadlines.get(cam_id, now):
+                outcome, reason = 'expired', f"nobody opened it within {self._idle_timeout:.0f} seconds"
+            else:
+                continue
+            with self._lock:
+                if self._keepers.get(cam_id) is not keeper:
+                    continue
+                del self._keepers[cam_id]
+                self._deadlines.pop(cam_id, None)
+            log.info(f"Done pre-rolling camera {keeper.cam.name}, {reason}")
+            keeper.stop()
+            metrics.PREROLL_TOTAL.inc(outcome)
+
+    def _run(self) -> None:
+        while not self._stop.wait(const.PREROLL_CHECK_INTERVAL):
+            self.check()
+
+    def start(self) -> None:
+        binary_sensors = [e for e in self._triggers if e.startswith('binary_sensor.')]
+        events = [e for e in self._triggers if not e.startswith('binary_sensor.')]
+        triggers = list()
+        if binary_sensors:
+            triggers.append({'platform': 'state', 'entity_id': binary_sensors, 'to': 'on'})
+        if events:
+            # Event entities change state to the time of each event
+            triggers.append({'platform': 'state', 'entity_id': events, 'not_to': ['unavailable', 'unknown']})
+        self._ws.subscribe_trigger('motion_preroll', triggers, self._on_trigger)
+        log.info(f"Pre-rolling cameras when any of {len(self._triggers)} Home Assistant entities fire")
+        Thread(target=self._run, name='motion-preroll', daemon=True).start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        with self._lock:
+            for keeper in self._keepers.values():
+                keeper.stop()
+            self._keepers.clear()
@@ -0,0 +1,185 @@
+import cProfile
+import json
+import os
+import pstats
+import sys
+import time
+from contextlib import contextmanager
+from itertools import count
+from threading import Lock, current_thread, local
+from typing import Callable
+
+import const
+from utils import data_path
+
+MODES = ('timing', 'cprofile')
+# From 3.12 cProfile sees every thread, but only one profile can run at a time
+SHARED_CPROFILE = sys.version_info >= (3, 12)
+
+_reports = count(1)
+_current = local()
+
+
+def _process_age() -> float:
+    """
+    Returns how long ago this process was started, which includes interpreter startup, or 0 if
+    we can't tell.
+    """
+    try:
+        with open('/proc/self/stat', 'r') as f:
+            started_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime', 'r') as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - started_ticks / os.sysconf('SC_CLK_TCK'))
+    except (IOError, OSError, ValueError, IndexError):
+        return 0.0
+
+
+class Profiler:
+    """
+    Times the phases of a run, so a slow start or a slow stream can be pinned on Python,
+    Home Assistant, Abode or AWS. Timings are always collected, since they cost next to nothing,
+    but a report is only written if profiling was turned on with the `profile` option or the
+    ABODE2RTC_PROFILE environment variable: `timing` writes a JSON breakdown of the phases, and
+    `cprofile` also saves cProfile data for the thread that turned it on and for the work it
+    hands to other threads with `wrap`. Reports go into the `profiles` folder under /data.
+    `startup` says whether the run started with the process, so interpreter startup counts.
+    """
+    def __init__(self, name: str, startup: bool = True) -> None:
+        self.name = name
+        self.mode = None
+        self._created = time.monotonic()
+        self._interpreter = _process_age() if startup else 0.0
+        self._last = self._created
+        self._phases = list()
+        self._lock = Lock()
+        self._cprofile = None
+        self._workers = list()
+        self.enable(os.environ.get('ABODE2RTC_PROFILE'))
+
+    def enable(self, mode: str = None) -> None:
+        if self.mode or not mode:
+            return
+        if mode not in MODES:
+            return
+        self.mode = mode
+        if mode == 'cprofile':
+            self._cprofile = cProfile.Profile()
+            try:
+                self._cprofile.enable()
+            except ValueError:
+                # Another run is being profiled already, so this one only gets timings
+                self._cprofile = None
+
+    def _record(self, name: str, start: float, end: float) -> None:
+        with self._lock:
+            self._phases.append({
+                'name': name,
+                'start': round(start - self._created, 6),
+                'duration': round(end - start, 6),
+                'thread': current_thread().name
+            })
+
+    def mark(self, name: str) -> None:
+        """
+        Records a phase that started when the last one marked this way ended (or when the
+        profiler was created) and ends now.
+        """
+        now = time.monotonic()
+        self._record(name, self._last, now)
+        self._last = now
+
+    @contextmanager
+    def phase(self, name: str):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self._record(name, start, time.monotonic())
+
+    def wrap(self, name: str, fn: Callable) -> Callable:
+        """
+        Returns `fn` timed as a phase, for work that is handed to another thread. Before 3.12
+        cProfile only sees the thread it was turned on in, so the other thread gets a profile of
+        its own that is added to ours when the report is written.
+        """
+        def timed(*args, **kwargs):
+            if self._cprofile is None or SHARED_CPROFILE:
+                with self.phase(name):
+                    return fn(*args, **kwargs)
+            worker = cProfile.Profile()
+            with self.phase(name):
+                worker.enable()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    worker.disable()
+                    with self._lock:
+                        self._workers.append(worker)
+        return timed
+
+    def _prune(self, directory: str) -> None:
+        reports = sorted((f for f in os.listdir(directory) if f.startswith(f"{self.name}-")),
+                         key=lambda f: os.path.getmtime(os.path.join(directory, f)))
+        for old in reports[:-const.PROFILE_KEEP]:
+            os.unlink(os.path.join(directory, old))
+
+    def finish(self, **details) -> str:
+        """
+        Writes the report, if profiling is on, and returns its path. `details` are added to it.
+        """
+        if not self.mode:
+            return None
+        directory = data_path('profiles')
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, f"{self.name}-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{next(_reports)}")
+        report = {
+            'name': self.name,
+            'mode': self.mode,
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': sys.version.split()[0],
+            'interpreter_startup': round(self._interpreter, 6),
+            'total': round(time.monotonic() - self._created + self._interpreter, 6),
+            **details,
+            'phases': sorted(self._phases, key=lambda p: p['start'])
+        }
+        if self._cprofile:
+            self._cprofile.disable()
+            stats = pstats.Stats(self._cprofile)
+            with self._lock:
+                for worker in self._workers:
+                    stats.add(worker)
+            stats.dump_stats(base + '.prof')
+            self._cprofile = None
+            report['cprofile'] = base + '.prof'
+        with open(base + '.json', 'w') as f:
+            json.dump(report, f, indent=2)
+        self._prune(directory)
+        return base + '.json'
+
+
+@contextmanager
+def active(profiler: Profiler):
+    """
+    Makes `profiler` the one that `phase` records into for this thread, if it isn't None.
+    """
+    previous = getattr(_current, 'profiler', None)
+    _current.profiler = profiler
+    try:
+        yield
+    finally:
+        _current.profiler = previous
+
+
+@contextmanager
+def phase(name: str):
+    """
+    Times a phase for whichever profiler is active in this thread, for code that doesn't know
+    whether it is being profiled.
+    """
+    profiler = getattr(_current, 'profiler', None)
+    if profiler is None:
+        yield
+        return
+    with profiler.phase(name):
+        yield
@@ -0,0 +1,67 @@
+from threading import Lock
+
+import requests
+
+import go2rtc
+from logger import log
+
+
+class StreamRegistry:
+    """
+    Keeps go2rtc's streams in line with the cameras we know about, using its REST API so that
+    cameras can come and go without restarting go2rtc (and dropping everyone who is watching).
+    Only streams that point at our resolver are touched; anything else in go2rtc is left alone.
+    """
+    def __init__(self, go2rtc_port: int, api_port: int) -> None:
+        self._go2rtc_port = go2rtc_port
+        self.api_port = api_port
+        self._source_prefix = go2rtc.echo_source(api_port, '')
+        self._lock = Lock()
+
+    def _is_ours(self, src: str) -> bool:
+        return src.startswith(self._source_prefix)
+
+    def current(self) -> dict:
+        """
+        Returns the streams go2rtc is serving for our cameras, as a dict of name to source.
+        """
+        streams = dict()
+        for name, info in (go2rtc.get_streams(self._go2rtc_port) or dict()).items():
+            sources = [p.get('url', '') for p in (info or dict()).get('producers') or list()]
+            ours = [src for src in sources if self._is_ours(src)]
+            if ours:
+                streams[name] = ours[0]
+        return streams
+
+    def apply(self, desired: dict) -> bool:
+        """
+        Adds, updates and removes streams so that go2rtc serves exactly `desired` (a dict of name
+        to source). Streams that are already correct aren't touched. Returns False if go2rtc
+        couldn't be reached or any stream couldn't be updated, so that the caller tries again.
+        """
+        with self._lock:
+            try:
+                current = self.current()
+            except requests.RequestException as exc:
+                log.error(f"Unable to get the stream list from go2rtc: {exc}")
+                return False
+            removed = current.keys() - desired.keys()
+            changed = {name: src for name, src in desired.items() if current.get(name) != src}
+            ok = True
+            for name in removed:
+                log.info(f"Removing camera {name} from go2rtc")
+                try:
+                    go2rtc.remove_stream(self._go2rtc_port, name)
+                except requests.RequestException as exc:
+                    log.error(f"Unable to remove camera {name} from go2rtc: {exc}")
+                    ok = False
+            for name, src in changed.items():
+                log.info(f"{'Updating' if name in current else 'Adding'} camera {name} in go2rtc")
+                try:
+                    if name in current:
+                        go2rtc.remove_stream(self._go2rtc_port, name)
+                    go2rtc.add_stream(self._go2rtc_port, name, src)
+                except requests.RequestException as exc:
+                    log.error(f"Unable to update camera {name} in go2rtc: {exc}")
+                    ok = False
+            return ok
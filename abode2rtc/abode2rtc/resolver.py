@@ -0,0 +1,282 @@
+from contextlib import ExitStack
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import time
+from threading import Lock, Thread
+from functools import partial
+from typing import Callable, Dict, List
+from urllib.parse import unquote, urlparse
+
+import const
+import metrics
+import profiling
+from abode import AbodeApiClient
+from accounts import AbodeAccount, AbodeAccounts
+from admission import AdmissionController, AdmissionError
+from cache import KVSCache, OfflineCache, SingleFlight
+from kvs import KVSEndpointData, parse_kvs_response
+from logger import log
+from profiling import Profiler
+from transport import CircuitOpenError
+
+
+class CameraOfflineError(Exception):
+    pass
+
+
+class StreamResolver:
+    """
+    Turns an Abode camera id into a go2rtc source, using a single long-lived (and already
+    authenticated) Abode client instead of starting a new interpreter for every viewer. With a
+    `profile` mode every request writes a report of where its time went.
+    """
+    def __init__(self, abode: AbodeApiClient, offline_path: str = None, admission: AdmissionController = None,
+                 priority: Callable[[str], int] = None, profile: str = None) -> None:
+        self._abode = abode
+        self._profile = profile
+        self._admission = admission or AdmissionController(abode.name)
+        self._priority = priority or (lambda cam_id: 0)
+        self._flights = SingleFlight()
+        self._cache = KVSCache(self._prefetch)
+        self._cache.start()
+        self._offline = OfflineCache(probe=self._probe, path=offline_path)
+        self._offline.start()
+        self._listeners: List[Callable[[str], None]] = list()
+        self._result_listeners: List[Callable[[str, str, float], None]] = list()
+
+    def add_listener(self, listener: Callable[[str], None]) -> None:
+        """
+        Registers a callback that is given the camera id every time go2rtc opens a camera.
+        """
+        self._listeners.append(listener)
+
+    def add_result_listener(self, listener: Callable[[str, str, float], None]) -> None:
+        """
+        Registers a callback that is given the camera id, the outcome (as in the resolve metric)
+        and how long it took, every time a camera has been resolved or failed to.
+        """
+        self._result_listeners.append(listener)
+
+    def _fetch(self, cam_id: str, priority: int) -> KVSEndpointData:
+        # Viewers, the prefetcher and the offline probe all share whichever call is in flight
+        return self._flights.do(cam_id, self._load, cam_id, priority)
+
+    def _prefetch(self, cam_id: str) -> KVSEndpointData:
+        return self._fetch(cam_id, const.KVS_BACKGROUND_PRIORITY)
+
+    def _load(self, cam_id: str, priority: int) -> KVSEndpointData:
+        with ExitStack() as admitted:
+            with profiling.phase('admission_wait'):
+                admitted.enter_context(self._admission.admit(cam_id, priority))
+            with profiling.phase('ensure_token'):
+                self._abode.ensure_token()
+            with profiling.phase('get_kvs_stream'):
+                kvs_data = self._abode.get_kvs_stream(cam_id)
+        if kvs_data is None:
+            raise CameraOfflineError(f"Camera {cam_id} is offline")
+        with profiling.phase('parse_kvs_response'):
+            return parse_kvs_response(kvs_data, cam_id)
+
+    def _probe(self, cam_id: str) -> bool:
+        # A successful probe is a perfectly good endpoint, so keep it for the next viewer
+        try:
+            self._cache.put(cam_id, self._prefetch(cam_id))
+        except CameraOfflineError:
+            return False
+        return True
+
+    def camera_status(self, cam_id: str, online: bool) -> None:
+        """
+        Applies a camera going offline or coming back, as pushed by Abode. Either way any cached
+        endpoint is dropped. A camera Abode says is offline isn't probed until it says otherwise,
+        apart from an occasional check in case we missed the event.
+        """
+        self._cache.invalidate(cam_id)
+        if online:
+            self._offline.mark_online(cam_id)
+        else:
+            self._offline.mark_offline(cam_id, backoff=const.OFFLINE_BACKOFF_MAX)
+
+    def resolve(self, cam_id: str) -> str:
+        start = time.monotonic()
+        result = 'error'
+        profiler = None
+        if self._profile:
+            profiler = Profiler('resolve', startup=False)
+            profiler.enable(self._profile)
+        try:
+            with profiling.active(profiler):
+                source, result = self._resolve(cam_id)
+            return source
+        except CameraOfflineError:
+            result = 'offline'
+            raise
+        except AdmissionError:
+            result = 'rejected'
+            raise
+        finally:
+            elapsed = time.monotonic() - start
+            metrics.RESOLVE_SECONDS.observe(elapsed, result)
+            for listener in self._result_listeners:
+                listener(cam_id, result, elapsed)
+            if profiler:
+                self._write_profile(profiler, cam_id, result)
+
+    def _write_profile(self, profiler: Profiler, cam_id: str, result: str) -> None:
+        try:
+            report = profiler.finish(camera=cam_id, result=result)
+        except OSError as exc:
+            log.warning(f"Unable to write stream profile for camera {cam_id}: {exc}")
+            return
+        log.debug(f"Wrote stream profile for camera {cam_id} to {report}")
+
+    def _resolve(self, cam_id: str) -> tuple:
+        cam_id = self._abode.camera(cam_id).id
+        for listener in self._listeners:
+            listener(cam_id)
+        if self._offline.is_offline(cam_id):
+            raise CameraOfflineError(f"Camera {cam_id} is offline, "
+                                     f"will check again in {self._offline.retry_in(cam_id):.0f} seconds")
+        kvs = self._cache.get(cam_id)
+        result = 'cached'
+        if kvs:
+            log.debug(f"Using cached KVS endpoint for camera {cam_id}")
+        else:
+            result = 'fetched'
+            try:
+                kvs = self._fetch(cam_id, self._priority(cam_id))
+            except CameraOfflineError:
+                self._offline.mark_offline(cam_id)
+                raise
+            self._cache.put(cam_id, kvs)
+        return kvs.to_go2rtc_source(), result
+
+
+class AccountResolver:
+    """
+    Sends each camera to a StreamResolver of its own account, so that every account has its own
+    caches and in-flight calls and one that is slow or locked out doesn't hold up the others.
+    Accounts that log in after startup get a resolver the first time one of their cameras is
+    opened. Each account has its own admission control, since Abode's limits are per account;
+    `priorities` maps camera ids, names or slugs to a priority for its queue. `profile` is passed
+    on to every resolver.
+    """
+    def __init__(self, accounts: AbodeAccounts, priorities: Dict[str, int] = None, profile: str = None,
+                 **limits) -> None:
+        self._accounts = accounts
+        self._priorities = priorities or dict()
+        self._profile = profile
+        self._limits = limits
+        self._resolvers: Dict[str, StreamResolver] = dict()
+        self._listeners: List[Callable[[str], None]] = list()
+        self._result_listeners: List[Callable[[str, str, float], None]] = list()
+        self._lock = Lock()
+
+    def add_listener(self, listener: Callable[[str], None]) -> None:
+        with self._lock:
+            self._listeners.append(listener)
+            for resolver in self._resolvers.values():
+                resolver.add_listener(listener)
+
+    def add_result_listener(self, listener: Callable[[str, str, float], None]) -> None:
+        with self._lock:
+            self._result_listeners.append(listener)
+            for resolver in self._resolvers.values():
+                resolver.add_result_listener(listener)
+
+    def _resolver(self, account: AbodeAccount) -> StreamResolver:
+        with self._lock:
+            resolver = self._resolvers.get(account.name)
+            if resolver is None:
+                resolver = self._resolvers[account.name] = StreamResolver(
+                    account.client, account.offline_path, AdmissionController(account.client.name, **self._limits),
+                    partial(self._priority, account), self._profile)
+                for listener in self._listeners:
+                    resolver.add_listener(listener)
+                for listener in self._result_listeners:
+                    resolver.add_result_listener(listener)
+            return resolver
+
+    def _priority(self, account: AbodeAccount, cam_id: str) -> int:
+        cam = account.client.cameras.by_id(cam_id)
+        keys = (cam.id, cam.name, account.client.cameras.slugs.get(cam.id))
+        return max((self._priorities[key] for key in keys if key in self._priorities), default=0)
+
+    def camera_status(self, account: AbodeAccount, cam_id: str, online: bool) -> None:
+        self._resolver(account).camera_status(cam_id, online)
+
+    def resolve(self, cam_id: str) -> str:
+        account, cam = self._accounts.find(cam_id)
+        return self._resolver(account).resolve(cam.id)
+
+
+class ResolverRequestHandler(BaseHTTPRequestHandler):
+    server: 'ResolverServer'
+
+    def _send(self, status: int, body: str, content_type: str = 'text/plain; charset=utf-8') -> None:
+        payload = body.encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _send_snapshot(self, cam_id: str) -> None:
+        try:
+            snapshot = self.server.snapshots.get(cam_id)
+        except KeyError as exc:
+            self._send(404, f"{exc.args[0]}\n")
+            return
+        if snapshot is None:
+            self._send(503, f"No snapshot of camera {cam_id} is available\n")
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(snapshot.image)))
+        self.send_header('Last-Modified', self.date_time_string(snapshot.taken_at))
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        self.wfile.write(snapshot.image)
+
+    def do_GET(self) -> None:
+        path = urlparse(self.path).path
+        if path == '/metrics':
+            self._send(200, metrics.render(), 'text/plain; version=0.0.4; charset=utf-8')
+            return
+        if path.startswith('/snapshot/') and self.server.snapshots:
+            self._send_snapshot(unquote(path[len('/snapshot/'):]))
+            return
+        if not path.startswith('/stream/'):
+            self._send(404, f"Unknown path {path}\n")
+            return
+        cam_id = unquote(path[len('/stream/'):])
+        try:
+            self._send(200, self.server.resolver.resolve(cam_id) + "\n")
+        except KeyError as exc:
+            self._send(404, f"{exc.args[0]}\n")
+        except (CameraOfflineError, CircuitOpenError, AdmissionError) as exc:
+            self._send(503, f"{exc}\n")
+        except Exception as exc:
+            log.error(f"Unable to resolve stream for camera {cam_id}", exc_info=exc)
+            self._send(500, f"{exc}\n")
+
+    def log_message(self, format: str, *args) -> None:
+        log.debug(f"Resolver: {self.address_string()} {format % args}")
+
+
+class ResolverServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # A dashboard opens all of its cameras at once, so don't make connections wait in SYN retries
+    request_queue_size = 64
+
+    def __init__(self, resolver: AccountResolver, port: int = const.DEFAULT_PORTS['api'],
+                 host: str = const.DEFAULT_API_HOST) -> None:
+        self.resolver = resolver
+        self.snapshots = None
+        super().__init__((host, port), ResolverRequestHandler)
+
+    def start(self) -> Thread:
+        host, port = self.server_address[:2]
+        log.info(f"Starting stream resolver on {host}:{port}")
+        thread = Thread(target=self.serve_forever, name='resolver', daemon=True)
+        thread.start()
+        return thread
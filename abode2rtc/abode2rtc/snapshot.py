@@ -0,0 +1,49 @@
+import json
+from dataclasses import asdict, dataclass, field
+from typing import Optional
+
+from logger import log
+from utils import atomic_write_json, data_path
+
+SNAPSHOT_VERSION = 1
+
+
+@dataclass
+class DiscoverySnapshot:
+    """
+    What we learned from Abode and Home Assistant on the last boot: the port assignments and the
+    go2rtc slug for each camera. Enough to start go2rtc straight away on the next boot while
+    discovery runs again in the background.
+    """
+    ports: dict
+    slugs: dict = field(default_factory=dict)
+
+    def to_json(self) -> dict:
+        return dict(version=SNAPSHOT_VERSION, **asdict(self))
+
+    @classmethod
+    def from_json(cls, data: dict) -> 'DiscoverySnapshot':
+        if data.get('version') != SNAPSHOT_VERSION:
+            raise ValueError(f"Unsupported snapshot version {data.get('version')}")
+        return cls(ports=data['ports'], slugs=data['slugs'])
+
+    @staticmethod
+    def _default_path() -> str:
+        return data_path('discovery.json')
+
+    def save(self, path: str = None) -> str:
+        path = path or self._default_path()
+        atomic_write_json(path, self.to_json())
+        return path
+
+    @classmethod
+    def load(cls, path: str = None) -> Optional['DiscoverySnapshot']:
+        path = path or cls._default_path()
+        try:
+            with open(path, 'r') as f:
+                return cls.from_json(json.load(f))
+        except FileNotFoundError:
+            return None
+        except (IOError, KeyError, ValueError) as exc:
+            log.warning(f"Ignoring unreadable discovery snapshot {path}: {exc}")
+            return None
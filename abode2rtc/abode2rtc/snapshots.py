@@ -0,0 +1,80 @@
+import time
+from dataclasses import dataclass, field
+from threading import Lock
+from typing import Dict, Optional
+
+import requests
+
+import const
+import go2rtc
+import metrics
+from cache import SingleFlight
+from cameras import CameraRegistry
+from logger import log
+
+
+@dataclass
+class Snapshot:
+    image: bytes
+    taken_at: float = field(default_factory=time.time)
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.taken_at
+
+
+class SnapshotCache:
+    """
+    Still images of each camera for picture cards and the like, taken from go2rtc. While a camera
+    is already streaming, grabbing a frame costs nothing, so snapshots are refreshed every few
+    seconds. Otherwise a frame means starting a stream from Abode, so snapshots are kept for `ttl`
+    seconds and concurrent requests for the same camera share one capture.
+    """
+    def __init__(self, go2rtc_port: int, cameras: CameraRegistry, ttl: float = const.SNAPSHOT_TTL) -> None:
+        self._go2rtc_port = go2rtc_port
+        self._cameras = cameras
+        self._ttl = ttl
+        self._snapshots: Dict[str, Snapshot] = dict()
+        self._flights = SingleFlight(metrics.SNAPSHOT_REQUESTS_PER_CAPTURE, 'snapshot capture')
+        self._lock = Lock()
+
+    def _is_streaming(self, slug: str) -> bool:
+        try:
+            info = (go2rtc.get_streams(self._go2rtc_port) or dict()).get(slug) or dict()
+        except requests.RequestException:
+            return False
+        return bool(info.get('consumers'))
+
+    def _capture(self, slug: str) -> Snapshot:
+        start = time.monotonic()
+        image = go2rtc.get_frame(self._go2rtc_port, slug)
+        metrics.SNAPSHOT_CAPTURE_SECONDS.observe(time.monotonic() - start)
+        return Snapshot(image)
+
+    def get(self, key: str) -> Optional[Snapshot]:
+        """
+        Returns a snapshot of the camera with the given id, name or slug. If a new one can't be
+        taken, the last one is returned however old it is, or None if there isn't one.
+        """
+        cam = self._cameras.lookup(key)
+        slug = self._cameras.slugs.get(cam.id)
+        if not slug:
+            raise KeyError(f"Camera {key} isn't in go2rtc yet")
+        with self._lock:
+            snapshot = self._snapshots.get(cam.id)
+        if snapshot and snapshot.age < const.SNAPSHOT_ACTIVE_TTL:
+            metrics.SNAPSHOT_REQUESTS_TOTAL.inc('cached')
+            return snapshot
+        if snapshot and snapshot.age < self._ttl and not self._is_streaming(slug):
+            metrics.SNAPSHOT_REQUESTS_TOTAL.inc('cached')
+            return snapshot
+        try:
+            snapshot = self._flights.do(cam.id, self._capture, slug)
+        except requests.RequestException as exc:
+            log.warning(f"Unable to take a snapshot of camera {cam.name}: {exc}")
+            metrics.SNAPSHOT_REQUESTS_TOTAL.inc('stale' if snapshot else 'error')
+            return snapshot
+        with self._lock:
+            self._snapshots[cam.id] = snapshot
+        metrics.SNAPSHOT_REQUESTS_TOTAL.inc('captured')
+        return snapshot
@@ -1,125 +1,370 @@
 #! /usr/bin/env python3
 
-import os
-import re
-import subprocess
-import tempfile
-
-from requests.exceptions import ConnectionError
-from jinja2 import Template
-
-from logger import log, go2rtc_log, DEBUG
-import go2rtc
-from hass import HassApiClient
-from abode import AbodeApiClient
-from config import ConfigParser
-import const
-
-
-def _cam_slug(cam_name: str, cam_id: str) -> str:
-    if have_hass and has_abode:
-        log.debug(f"Looking for a camera in Home Assistant that matches id {cam_id}")
-        for cam in hass_cameras:
-            if 'device_id' in cam['attributes']:
-                log.debug(f"Comparing {cam_id} to {cam['attributes']['device_id']}")
-            if 'device_id' in cam['attributes'] and cam['attributes']['device_id'] == cam_id:
-                entity_id = cam['entity_id'].replace('camera.', '')
-                log.debug(f"Found camera in Home Assistant, go2rtc slug will be {entity_id}")
-                return entity_id
-    else:
-        slug = cam_name.lower().replace(' ', '_')
-        log.debug(f"Home Assistant API not available, go2rtc slug will default to {slug}")
-        return slug
+from profiling import Profiler
+
+profiler = Profiler('spawn')
+
+import os  # noqa: E402
+import signal  # noqa: E402
+import tempfile  # noqa: E402
+import time  # noqa: E402
+from concurrent.futures import ThreadPoolExecutor  # noqa: E402
+from threading import Event, Lock, Thread  # noqa: E402
+
+from requests.exceptions import ConnectionError  # noqa: E402
+from jinja2 import Template  # noqa: E402
+
+from logger import log, go2rtc_log, DEBUG  # noqa: E402
+import go2rtc  # noqa: E402
+from hass import HassApiClient  # noqa: E402
+from hass_ws import AbodeCameraDiscovery, HassWebSocket  # noqa: E402
+from abode_events import AbodeDeviceWatcher, AbodeEventSocket  # noqa: E402
+from accounts import AbodeAccount, AbodeAccounts  # noqa: E402
+from registry import StreamRegistry  # noqa: E402
+from resolver import AccountResolver, ResolverServer  # noqa: E402
+from snapshot import DiscoverySnapshot  # noqa: E402
+from preroll import MotionPreroll  # noqa: E402
+from health import StreamHealth  # noqa: E402
+from snapshots import SnapshotCache  # noqa: E402
+from warm import WarmStreams  # noqa: E402
+from config import ConfigParser  # noqa: E402
+import const  # noqa: E402
+
+profiler.mark('imports')
 
 
-def add_slugs(cameras) -> None:
-    for cam in cameras:
-        cam['slug'] = _cam_slug(cam['name'], cam['id'])
+def _cam_slug(cam_name: str, cam_id: str, hass_slugs: dict, account: AbodeAccount) -> str:
+    if hass_slugs and cam_id in hass_slugs:
+        log.debug(f"Found camera {cam_id} in Home Assistant, go2rtc slug will be {hass_slugs[cam_id]}")
+        return hass_slugs[cam_id]
+    slug = account.stream_name(cam_name.lower().replace(' ', '_'))
+    log.debug(f"No matching camera in Home Assistant, go2rtc slug will default to {slug}")
+    return slug
 
 
-def write_go2rtc_config(cameras) -> str:
-    add_slugs(cameras)
+def camera_slugs(accounts: AbodeAccounts, hass_slugs, previous=None) -> dict:
+    slugs = dict()
+    for account in accounts.ready:
+        for cam in account.client.cameras:
+            # If Home Assistant couldn't be reached, stick with the slugs we had last time
+            if hass_slugs is None and previous and previous.get(cam.id):
+                slugs[cam.id] = previous[cam.id]
+            else:
+                slugs[cam.id] = _cam_slug(cam.name, cam.id, hass_slugs or dict(), account)
+    return slugs
+
+
+def camera_streams(slugs: dict, api_port: int) -> dict:
+    return {slug: go2rtc.echo_source(api_port, cam_id) for cam_id, slug in slugs.items()}
+
+
+def write_go2rtc_config(ports, streams=None, debug=False) -> str:
     my_dir = os.path.dirname(__file__)
     template_path = os.path.join(my_dir, 'go2rtc.yaml.j2')
-    template = Template(open(template_path).read())
     yaml_path = os.path.join(tempfile.gettempdir(), 'go2rtc.yaml')
-    stream_path = os.path.join(my_dir, "stream.py")
-    with open(yaml_path, 'w') as f:
+    with profiler.phase('template_render'), open(yaml_path, 'w') as f:
+        template = Template(open(template_path).read())
         log.info(f"Writing go2rtc configuration to {yaml_path}")
-        f.write(template.render(
-            cameras=cameras, ports=ports, abode_conf=abode_conf, stream_path=stream_path
-        ))
+        f.write(template.render(streams=streams or dict(), ports=ports, debug=debug))
     return yaml_path
 
 
-def run_go2rtc(bin_path, config_path):
-    log.info("Starting go2rtc...")
-    p = subprocess.Popen([bin_path, '-config', config_path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
-    ansi_escape = re.compile(r'\x1B(?:[@-Z\\-_]|\[[0-?]*[ -/]*[@-~])')
-    while not p.poll():
-        buf = ""
-        for line in p.stdout:
-            line: str = line.decode('utf-8').strip()
-            if not line:
+def login_to_abode(account: AbodeAccount) -> bool:
+    try:
+        account.login()
+    except Exception as exc:
+        delay = account.login_failed(exc)
+        if delay is None:
+            log.error(f"{account.label} turned the username and password away, not trying again until the "
+                      f"add-on is restarted", exc_info=exc)
+        else:
+            log.error(f"Unable to log into {account.label}, will try again in {delay / 60:.0f} minutes", exc_info=exc)
+        return False
+    return True
+
+
+def default_ports(config) -> dict:
+    ports = const.DEFAULT_PORTS.copy()
+    ports.update({'api': config.port})
+    return ports
+
+
+def sync_cameras() -> None:
+    """
+    Brings go2rtc and the saved snapshot in line with the current Abode cameras and their Home
+    Assistant entities. If go2rtc can't be updated (while it is being restarted, say) nothing is
+    saved, so that the next call tries again.
+    """
+    global go2rtc_stale
+    with sync_lock:
+        slugs = camera_slugs(accounts, hass_slugs(), discovered.slugs)
+        if slugs == discovered.slugs and not go2rtc_stale:
+            return
+        log.info("Cameras have changed, updating go2rtc")
+        if not registry.apply(camera_streams(slugs, registry.api_port)):
+            log.warning("Unable to bring go2rtc up to date, will try again")
+            go2rtc_stale = True
+            return
+        go2rtc_stale = False
+        accounts.set_slugs(slugs)
+        discovered.slugs = slugs
+        discovered.save()
+        if warm_streams:
+            warm_streams.update()
+
+
+def watch_account(account: AbodeAccount) -> None:
+    """
+    Subscribes to an account's event feed, so that camera changes reach go2rtc and cameras
+    going offline or coming back reach the resolver as they happen.
+    """
+    account.events = AbodeDeviceWatcher(AbodeEventSocket(account.client, account.client.name), account.client)
+    account.events.add_camera_listener(sync_cameras)
+    account.events.add_status_listener(lambda cam_id, online: stream_resolver.camera_status(account, cam_id, online))
+    if stream_health:
+        account.events.add_status_listener(stream_health.camera_status)
+    account.events.start()
+
+
+def poll_devices(stop: Event) -> None:
+    """
+    Checks Abode for new, renamed or removed cameras every so often and updates go2rtc to match.
+    Accounts whose event feed is connected hear about changes as they happen, so they are only
+    checked once in a while in case an event went missing. Accounts that couldn't log in at
+    startup are tried again with a growing delay, and Home Assistant, if it couldn't be reached,
+    each time.
+    """
+    next_poll = dict()
+    while not stop.wait(const.DEVICE_POLL_INTERVAL):
+        for account in accounts:
+            if not account.client:
+                if account.login_due and login_to_abode(account):
+                    watch_account(account)
                 continue
-            line = ansi_escape.sub('', line)
-            if line[0].isdigit() and buf:
-                try:
-                    _, severity, message = buf.split(' ', maxsplit=2)
-                    if severity == 'ERR':
-                        go2rtc_log.error(message)
-                    elif severity == 'WRN':
-                        go2rtc_log.warning(message)
-                    elif severity == 'INF':
-                        go2rtc_log.info(message)
-                    elif severity == 'DBG' or severity == 'TRC':
-                        go2rtc_log.debug(message)
-                    else:
-                        go2rtc_log.info(buf)
-                except ValueError:
-                    go2rtc_log.info(buf)
-                buf = ""
-            buf += line
-    if p.returncode:
-        log.warning(f"Exit code from go2rtc is {p.returncode}")
-    else:
-        log.info("go2rtc exited normally")
+            if account.events and account.events.connected and time.monotonic() < next_poll.get(account.name, 0):
+                continue
+            try:
+                account.client.refresh_devices()
+                account.client.save()
+            except Exception as exc:
+                log.warning(f"Unable to refresh camera list from {account.label}: {exc}")
+            next_poll[account.name] = time.monotonic() + const.DEVICE_POLL_INTERVAL_EVENTS
+        if hass_discovery is None and initial_hass_slugs is None:
+            retry_hass_discovery()
+        try:
+            sync_cameras()
+        except Exception as exc:
+            log.error("Unable to update go2rtc with the current cameras", exc_info=exc)
+
+
+def get_ports(hass: HassApiClient) -> dict:
+    try:
+        return hass.get_addon_ports()
+    except Exception as exc:
+        log.error("Unable to get port assignments from Home Assistant", exc_info=exc)
+        return None
+
+
+def discover_hass_cameras(hass: HassApiClient, config) -> tuple:
+    """
+    Returns the Home Assistant camera discovery (which keeps itself up to date) and the slugs it
+    found, or no discovery and no slugs if Home Assistant couldn't be reached.
+    """
+    ws = None
+    try:
+        if hass.has_abode_integration():
+            log.info("Home Assistant has the Abode integration installed")
+            ws = HassWebSocket(token=config.supervisor_token, supervisor_url=config.supervisor_url)
+            ws.start()
+            discovery = AbodeCameraDiscovery(ws)
+            slugs = discovery.start()
+            log.info(f"Found {len(slugs)} Abode cameras in Home Assistant")
+            return discovery, slugs
+        else:
+            log.info("Home Assistant does not have the Abode integration installed")
+            log.warning("Autogenerated camera names may not match the entities in Home Assistant")
+            return None, dict()
+    except ConnectionError as exc:
+        log.error("Unable to communicate with Home Assistant", exc_info=exc)
+    except Exception as exc:
+        log.error("Unknown error trying to connect to Home Assistant", exc_info=exc)
+    if ws:
+        ws.close()
+    log.warning("Autogenerated camera names may not match the entities in Home Assistant")
+    return None, None
+
+
+def retry_hass_discovery() -> None:
+    """
+    Tries to find the cameras in Home Assistant again if it couldn't be reached at startup (while
+    it was restarting after an update, say). Once it answers, discovery keeps itself up to date.
+    """
+    global hass_discovery, initial_hass_slugs
+    discovery, slugs = discover_hass_cameras(hass, config)
+    if slugs is None:
+        return
+    if discovery:
+        discovery.add_listener(lambda _: sync_cameras())
+    hass_discovery, initial_hass_slugs = discovery, slugs
+
+
+def preroll_websocket(config) -> HassWebSocket:
+    """
+    Returns a Home Assistant WebSocket connection for motion pre-roll: the one camera discovery
+    already has, or a new one if Home Assistant doesn't have the Abode integration.
+    """
+    if hass_discovery:
+        return hass_discovery.ws
+    try:
+        ws = HassWebSocket(token=config.supervisor_token, supervisor_url=config.supervisor_url)
+        ws.start()
+        return ws
+    except Exception as exc:
+        log.error("Unable to connect to Home Assistant, motion pre-roll is off", exc_info=exc)
+        return None
+
+
+def current_go2rtc_config() -> str:
+    """
+    Writes go2rtc's config for the cameras we know about now, for when go2rtc has to be restarted.
+    """
+    if discovered:
+        return write_go2rtc_config(discovered.ports, camera_streams(discovered.slugs, ports['api']), config.debug)
+    return write_go2rtc_config(ports, streams, config.debug)
+
+
+def hass_slugs() -> dict:
+    return hass_discovery.slugs if hass_discovery else initial_hass_slugs
 
 
 config = ConfigParser()
+profiler.enable(config.profile)
 if config.debug:
     log.setLevel(DEBUG)
     go2rtc_log.setLevel(DEBUG)
+profiler.mark('config_parse')
 
+hass = HassApiClient(token=config.supervisor_token, supervisor_url=config.supervisor_url)
+snapshot = DiscoverySnapshot.load()
+accounts = AbodeAccounts.from_options(config.abode_username, config.abode_password, config.locale, config.accounts)
+restored = [account for account in accounts if account.restore()] if snapshot else list()
+stream_resolver = AccountResolver(
+    accounts, priorities={p['camera']: p['priority'] for p in config.camera_priorities or list()},
+    profile=profiler.mode,
+    max_active=config.kvs_max_sessions or const.KVS_MAX_SESSIONS,
+    max_per_key=config.kvs_max_per_camera or const.KVS_MAX_PER_CAMERA,
+    max_queue=const.KVS_QUEUE_SIZE if config.kvs_queue_size is None else config.kvs_queue_size)
+resolver = None
+discovered = None
+profiler.mark('state_load')
 
-abode = AbodeApiClient(username=config.abode_username, password=config.abode_password, locale=config.locale)
-abode_conf = abode.save()
+# None of these depend on each other, so run them side by side. On a warm start go2rtc comes up
+# straight away with the cameras from the last boot, and anything discovery turns up is applied
+# afterwards. On a cold start go2rtc starts as soon as we know which ports to use, and the
+# cameras get pushed to it once discovery has finished. Each Abode account logs in (or
+# revalidates its saved state) on its own, so a slow account doesn't hold up the others.
+with ThreadPoolExecutor(max_workers=3 + len(accounts), thread_name_prefix='startup') as pool:
+    go2rtc_path_future = pool.submit(profiler.wrap('binary_lookup', go2rtc.find_or_download), config.go2rtc_mirror)
+    ports_future = pool.submit(profiler.wrap('supervisor_ports', get_ports), hass)
+    hass_cameras_future = pool.submit(profiler.wrap('hass_discovery', discover_hass_cameras), hass, config)
+    account_futures = [
+        pool.submit(profiler.wrap('abode_revalidate', account.revalidate)) if account in restored
+        else pool.submit(profiler.wrap('abode_login', login_to_abode), account)
+        for account in accounts
+    ]
+    if restored:
+        log.info("Starting from saved discovery snapshot, revalidating in the background")
+        ports = snapshot.ports
+        streams = camera_streams(snapshot.slugs, ports['api'])
+        resolver = ResolverServer(stream_resolver, port=ports['api'])
+        resolver.start()
+    else:
+        ports = ports_future.result() or default_ports(config)
+        streams = dict()
 
-have_hass = False
-has_abode = False
-ports = const.DEFAULT_PORTS.copy()
-ports.update({'api': config.port})
-hass_cameras = list()
-hass = HassApiClient(token=config.supervisor_token, supervisor_url=config.supervisor_url)
-try:
-    ports = hass.get_addon_ports()
-    has_abode = hass.has_abode_integration()
-    if has_abode:
-        log.info("Home Assistant has the Abode integration installed")
-        hass_cameras = hass.get_abode_cams()
-        have_hass = True
-        log.info(f"Found {len(hass_cameras)} Abode cameras in Home Assistant")
+    go2rtc_path = go2rtc_path_future.result()
+    go2rtc_supervisor = go2rtc.Go2rtcSupervisor(go2rtc_path, current_go2rtc_config, ports['go2rtc'])
+    with profiler.phase('go2rtc_launch'):
+        go2rtc_supervisor.start(write_go2rtc_config(ports, streams, config.debug))
+    if profiler.mode:
+        pool.submit(profiler.wrap('go2rtc_ready', go2rtc.wait_for_api), ports['go2rtc'])
+
+    for future in account_futures:
+        future.result()
+    if not accounts.ready:
+        raise RuntimeError("Unable to log into any Abode account")
+    if not resolver:
+        resolver = ResolverServer(stream_resolver, port=ports['api'])
+        resolver.start()
+
+    hass_discovery, initial_hass_slugs = hass_cameras_future.result()
+    discovered = DiscoverySnapshot(ports=ports_future.result() or ports,
+                                   slugs=camera_slugs(accounts, initial_hass_slugs,
+                                                      snapshot.slugs if snapshot else None))
+    accounts.set_slugs(discovered.slugs)
+
+registry = StreamRegistry(ports['go2rtc'], ports['api'])
+go2rtc_stale = False
+if discovered == snapshot:
+    log.info("Discovery matches the saved snapshot, nothing to update")
+else:
+    new_streams = camera_streams(discovered.slugs, ports['api'])
+    if discovered.ports != ports:
+        log.info("Port assignments have changed, restarting go2rtc")
+        go2rtc_supervisor.restart(write_go2rtc_config(discovered.ports, new_streams, config.debug),
+                                  api_port=discovered.ports['go2rtc'])
+        registry = StreamRegistry(discovered.ports['go2rtc'], ports['api'])
+    elif go2rtc.wait_for_api(ports['go2rtc']) and registry.apply(new_streams):
+        log.info(f"go2rtc is serving {len(new_streams)} cameras")
     else:
-        log.info("Home Assistant does not have the Abode integration installed")
-except ConnectionError as exc:
-    have_hass = False
-    log.error("Unable to communicate with Home Assistant", exc_info=exc)
-except Exception as exc:
-    log.error("Unknown error trying to connect to Home Assistant", exc_info=exc)
-
-if not (have_hass and has_abode):
-    log.warning("Autogenerated camera names may not match the entities in Home Assistant")
+        log.warning("Unable to bring go2rtc up to date, will try again")
+        go2rtc_stale = True
+    if not go2rtc_stale:
+        discovered.save()
+
+resolver.snapshots = SnapshotCache(discovered.ports['go2rtc'], accounts.cameras,
+                                   ttl=config.snapshot_ttl or const.SNAPSHOT_TTL)
+
+warm_streams = None
+if config.always_on:
+    warm_streams = WarmStreams(discovered.ports['go2rtc'], accounts.cameras, selected=config.always_on_cameras,
+                               max_streams=config.always_on_max or const.WARM_MAX_STREAMS,
+                               idle_timeout=const.WARM_IDLE_TIMEOUT if config.always_on_idle_minutes is None
+                               else config.always_on_idle_minutes * 60)
+    stream_resolver.add_listener(warm_streams.touch)
+    warm_streams.start()
+
+motion_preroll = None
+if config.motion_preroll and config.motion_preroll_triggers:
+    preroll_ws = preroll_websocket(config)
+    if preroll_ws:
+        motion_preroll = MotionPreroll(preroll_ws, discovered.ports['go2rtc'], accounts.cameras,
+                                       {t['entity']: t['camera'] for t in config.motion_preroll_triggers},
+                                       idle_timeout=config.motion_preroll_idle_seconds or const.PREROLL_IDLE_TIMEOUT)
+        motion_preroll.start()
+
+stream_health = None
+if config.health_sensors:
+    if hass.has_api:
+        stream_health = StreamHealth(hass, discovered.ports['go2rtc'], accounts)
+        stream_resolver.add_result_listener(stream_health.resolved)
+        stream_health.start()
+    else:
+        log.warning("Stream health sensors need the Home Assistant API, which isn't available")
+
+sync_lock = Lock()
+if hass_discovery:
+    hass_discovery.add_listener(lambda _: sync_cameras())
+for account in accounts.ready:
+    watch_account(account)
+stop_polling = Event()
+Thread(target=poll_devices, name='device-poll', daemon=True, args=(stop_polling,)).start()
+
+profiler.mark('startup')
+profile_report = profiler.finish()
+if profile_report:
+    log.info(f"Wrote startup profile to {profile_report}")
 
-go2rtc_conf = write_go2rtc_config(abode.cameras)
-go2rtc_path = go2rtc.find_or_download()
-run_go2rtc(go2rtc_path, go2rtc_conf)
+signal.signal(signal.SIGTERM, lambda *_: go2rtc_supervisor.stop())
+go2rtc_supervisor.wait()
+stop_polling.set()
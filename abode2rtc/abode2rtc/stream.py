@@ -2,21 +2,52 @@
 
 import sys
 
-from abode import AbodeApiClient
-from kvs import parse_kvs_response
+from profiling import Profiler
 
+profiler = Profiler('stream')
+
+from accounts import AbodeAccounts  # noqa: E402
+from cache import OfflineCache, SharedKVSCache  # noqa: E402
+from config import load_options  # noqa: E402
+from kvs import KVSEndpointData, parse_kvs_response  # noqa: E402
+from logger import log  # noqa: E402
+
+profiler.mark('imports')
 
 abode_conf = sys.argv[1]
 cam_id = sys.argv[2]
 
-with AbodeApiClient.load(abode_conf) as abode:
-    abode.login()
-    kvs_data = abode.get_kvs_stream(cam_id)
-    kvs = parse_kvs_response(kvs_data, cam_id)
+options = load_options()
+profiler.enable(options.get('profile'))
+accounts = AbodeAccounts.from_options(options.get('abode_username'), options.get('abode_password'),
+                                      options.get('locale'), options.get('accounts'))
+account = accounts.for_state_path(abode_conf)
+offline = OfflineCache(path=account.offline_path)
+with account.load(abode_conf) as abode:
+    profiler.mark('state_load')
+    cam_id = abode.camera(cam_id).id
+    if offline.is_offline(cam_id):
+        log.warning(f"Camera {cam_id} is offline, will check again in {offline.retry_in(cam_id):.0f} seconds")
+        profiler.finish()
+        sys.exit(1)
+
+    def fetch(cam_id: str) -> KVSEndpointData:
+        with profiler.phase('login'):
+            abode.ensure_token()
+        with profiler.phase('kvs_call'):
+            kvs_data = abode.get_kvs_stream(cam_id)
+        if kvs_data is None:
+            offline.mark_offline(cam_id)
+            profiler.finish()
+            sys.exit(1)
+        offline.mark_online(cam_id)
+        with profiler.phase('parse'):
+            return parse_kvs_response(kvs_data, cam_id)
+
+    kvs = SharedKVSCache().get(cam_id, fetch)
+    profiler.mark('resolve')
 
-print(f"webrtc:{kvs.endpoint_url}"
-      "#format=kinesis"
-      f"#client_id={kvs.client_id}"
-      f"#ice_servers={kvs.ice_servers}")
+print(kvs.to_go2rtc_source())
+profiler.finish()
 
 sys.exit(0)
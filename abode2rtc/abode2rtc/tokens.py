@@ -0,0 +1,85 @@
+import random
+import time
+from threading import Event, Lock, Thread
+from typing import Dict
+
+import const
+import metrics
+from logger import log
+
+
+class TokenRefresher:
+    """
+    A single background thread that renews the access token of every registered Abode client
+    shortly before it expires. Each refresh is scheduled from the token's own expiry, moved
+    earlier by a random amount so that several add-ons or accounts don't all hit Abode at the same
+    moment, and a failed refresh is retried with backoff instead of ending the schedule.
+    """
+    def __init__(self) -> None:
+        self._due: Dict[object, float] = dict()
+        self._backoff: Dict[object, float] = dict()
+        self._lock = Lock()
+        self._wake = Event()
+        self._thread = None
+
+    @staticmethod
+    def _next_refresh(client) -> float:
+        due = client.token_expires - const.TOKEN_REFRESH_MARGIN - random.uniform(0, const.TOKEN_REFRESH_JITTER)
+        return max(due, time.time() + const.TOKEN_RETRY_MIN)
+
+    def add(self, client) -> None:
+        with self._lock:
+            self._due[client] = self._next_refresh(client)
+            self._backoff.pop(client, None)
+            if not self._thread:
+                self._thread = Thread(target=self._run, name='token-refresh', daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def remove(self, client) -> None:
+        with self._lock:
+            self._due.pop(client, None)
+            self._backoff.pop(client, None)
+
+    def reschedule(self, client) -> None:
+        """
+        Called when a client gets a new token some other way, so the next refresh follows it.
+        """
+        with self._lock:
+            if client in self._due:
+                self._due[client] = self._next_refresh(client)
+                self._backoff.pop(client, None)
+        self._wake.set()
+
+    def _refresh(self, client) -> None:
+        try:
+            client.refresh_token()
+        except Exception as exc:
+            metrics.TOKEN_REFRESH_FAILURES_TOTAL.inc()
+            with self._lock:
+                if client not in self._due:
+                    return
+                backoff = min(self._backoff.get(client, const.TOKEN_RETRY_MIN / 2) * 2, const.TOKEN_RETRY_MAX)
+                self._backoff[client] = backoff
+                self._due[client] = time.time() + backoff * random.uniform(0.8, 1.2)
+            log.warning(f"Unable to refresh Abode access token ({exc}), trying again in {backoff:.0f} seconds")
+            return
+        with self._lock:
+            if client in self._due:
+                self._due[client] = self._next_refresh(client)
+                self._backoff.pop(client, None)
+
+    def _run(self) -> None:
+        while True:
+            with self._lock:
+                now = time.time()
+                due = [c for c, t in self._due.items() if t <= now]
+                wait = min(self._due.values(), default=now + 3600) - now
+            for client in due:
+                self._refresh(client)
+            if not due:
+                self._wake.wait(max(wait, 0))
+                self._wake.clear()
+
+
+token_refresher = TokenRefresher()
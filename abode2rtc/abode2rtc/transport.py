@@ -0,0 +1,172 @@
+import random
+import time
+from threading import Lock
+from typing import Dict
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+import const
+import metrics
+from logger import log
+
+IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'))
+RETRY_STATUSES = frozenset((429, 502, 503, 504))
+
+
+def _never_sent(exc: requests.RequestException) -> bool:
+    """
+    Whether a request failed before it could reach the server (the connection timed out, was
+    refused or the name didn't resolve), so retrying it can't repeat anything.
+    """
+    if isinstance(exc, requests.ConnectTimeout):
+        return True
+    reason = exc.args[0] if exc.args else None
+    return isinstance(getattr(reason, 'reason', reason), NewConnectionError)
+
+
+class CircuitOpenError(requests.ConnectionError):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stops calling a service that keeps failing. After `threshold` failures in a row the circuit
+    opens and calls fail straight away; once `reset_after` seconds have passed a single trial call
+    is let through, which closes the circuit again if it succeeds.
+    """
+    def __init__(self, name: str, threshold: int = const.HTTP_BREAKER_THRESHOLD,
+                 reset_after: float = const.HTTP_BREAKER_RESET) -> None:
+        self.name = name
+        self._threshold = threshold
+        self._reset_after = reset_after
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+        self._lock = Lock()
+        metrics.HTTP_CIRCUIT_OPEN.set(0, name)
+
+    @property
+    def is_open(self) -> bool:
+        return self._opened_at is not None
+
+    def allow(self) -> None:
+        with self._lock:
+            if self._opened_at is None:
+                return
+            retry_in = self._opened_at + self._reset_after - time.monotonic()
+            if retry_in > 0 or self._trial:
+                metrics.HTTP_CIRCUIT_REJECTED_TOTAL.inc(self.name)
+                raise CircuitOpenError(f"{self.name} is unavailable, not retrying for another "
+                                       f"{max(retry_in, 0):.0f} seconds")
+            self._trial = True
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self._opened_at is not None:
+                log.info(f"{self.name} is responding again")
+            self._failures = 0
+            self._opened_at = None
+            self._trial = False
+            metrics.HTTP_CIRCUIT_OPEN.set(0, self.name)
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self._failures += 1
+            if self._trial or (self._opened_at is None and self._failures >= self._threshold):
+                if self._opened_at is None:
+                    log.warning(f"{self.name} has failed {self._failures} times in a row, "
+                                f"pausing requests for {self._reset_after} seconds")
+                self._opened_at = time.monotonic()
+                self._trial = False
+                metrics.HTTP_CIRCUIT_OPEN.set(1, self.name)
+
+
+_breakers: Dict[str, CircuitBreaker] = dict()
+_breakers_lock = Lock()
+
+
+def circuit_breaker(name: str) -> CircuitBreaker:
+    """
+    Returns the circuit breaker for a service, shared by every client that talks to it.
+    """
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+class Transport:
+    """
+    A requests session with a keep-alive pool sized for how many calls we make at once, connect
+    and read timeouts on every call, retries with exponential backoff and jitter for calls that
+    are safe to repeat, and a circuit breaker so that we fail fast while a service is down.
+    """
+    def __init__(self, name: str, pool_size: int = const.HTTP_POOL_SIZE,
+                 timeout: tuple = (const.HTTP_CONNECT_TIMEOUT, const.HTTP_READ_TIMEOUT),
+                 retries: int = const.HTTP_RETRIES) -> None:
+        self.name = name
+        self.timeout = timeout
+        self.retries = retries
+        self.breaker = circuit_breaker(name)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
+    @property
+    def headers(self):
+        return self._session.headers
+
+    @property
+    def cookies(self):
+        return self._session.cookies
+
+    @staticmethod
+    def _backoff(attempt: int, response: requests.Response = None) -> float:
+        retry_after = response.headers.get('Retry-After', '') if response is not None else ''
+        if retry_after.isdigit():
+            return min(float(retry_after), const.HTTP_BACKOFF_MAX)
+        return min(const.HTTP_BACKOFF_BASE * 2 ** attempt, const.HTTP_BACKOFF_MAX) * random.uniform(0.5, 1.5)
+
+    def request(self, method: str, url: str, idempotent: bool = None, **kwargs) -> requests.Response:
+        """
+        Makes a request, retrying connection failures, timeouts and 429/502/503/504 responses if
+        the request is idempotent. Requests that never reached the server are always retried.
+        """
+        method = method.upper()
+        if idempotent is None:
+            idempotent = method in IDEMPOTENT_METHODS
+        kwargs.setdefault('timeout', self.timeout)
+        attempt = 0
+        while True:
+            self.breaker.allow()
+            start = time.monotonic()
+            try:
+                response = self._session.request(method, url, **kwargs)
+            except requests.RequestException as exc:
+                metrics.HTTP_ATTEMPT_SECONDS.observe(time.monotonic() - start, self.name, 'error')
+                self.breaker.record_failure()
+                retryable = _never_sent(exc) or (
+                    idempotent and isinstance(exc, (requests.ConnectionError, requests.Timeout)))
+                if attempt >= self.retries or not retryable:
+                    raise
+                delay = self._backoff(attempt)
+                log.info(f"{method} {url} to {self.name} failed ({exc}), retrying in {delay:.1f} seconds")
+            else:
+                failed = response.status_code >= 500
+                metrics.HTTP_ATTEMPT_SECONDS.observe(time.monotonic() - start, self.name,
+                                                     'error' if failed else 'ok')
+                if failed:
+                    self.breaker.record_failure()
+                else:
+                    self.breaker.record_success()
+                if response.status_code not in RETRY_STATUSES or not idempotent or attempt >= self.retries:
+                    return response
+                delay = self._backoff(attempt, response)
+                log.info(f"{method} {url} to {self.name} returned {response.status_code}, "
+                         f"retrying in {delay:.1f} seconds")
+            metrics.HTTP_RETRIES_TOTAL.inc(self.name)
+            attempt += 1
+            time.sleep(delay)
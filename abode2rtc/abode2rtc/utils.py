@@ -1,4 +1,12 @@
+import base64
+import fcntl
+import json
+import os
+import tempfile
 import uuid
+from contextlib import contextmanager
+
+import const
 
 
 def generate_uuid() -> str:
@@ -20,3 +28,55 @@ def obscure_passwords(data: dict) -> dict:
         elif key == 'Authorization':
             options[key] = 'Bearer **********'
     return options
+
+
+def decode_jwt_claims(token: str) -> dict:
+    """
+    Decodes the payload of a JSON Web Token without verifying its signature. Returns an empty
+    dict if the token isn't a JWT.
+    """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload))
+    except (AttributeError, IndexError, ValueError):
+        return dict()
+
+
+@contextmanager
+def file_lock(path: str):
+    """
+    Holds an exclusive advisory lock on `path` for the duration of the block. Works across
+    processes as well as threads, so concurrent stream resolvers can take turns.
+    """
+    with open(path, 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield f
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def atomic_write_json(path: str, data) -> None:
+    """
+    Writes JSON to a temporary file next to `path` and renames it into place, so readers never
+    see a half-written file.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def data_path(filename: str) -> str:
+    """
+    Returns where to keep a state file: the add-on's persistent /data directory if we have one,
+    otherwise the temp directory (when running outside of Home Assistant).
+    """
+    if os.access(const.DATA_DIR, os.W_OK):
+        return os.path.join(const.DATA_DIR, filename)
+    return os.path.join(tempfile.gettempdir(), filename)
@@ -0,0 +1,187 @@
+import time
+from collections import deque
+from threading import Event, Lock, Thread
+from typing import Dict, List
+
+import requests
+
+import const
+import go2rtc
+import metrics
+from cameras import Camera, CameraRegistry
+from logger import log
+
+
+class StreamKeeper:
+    """
+    Holds a single consumer connection open to one go2rtc stream, so that go2rtc keeps the
+    camera's producer running and viewers join a stream that is already connected. The connection
+    is renewed every so often to get a fresh KVS session, but only while nobody else is watching,
+    since dropping it would otherwise do nothing. Each camera may only connect so many times an
+    hour; once that budget is used up the camera is left cold until it frees up again.
+    """
+    def __init__(self, go2rtc_port: int, cam: Camera, slug: str, kind: str = 'always-on') -> None:
+        self.cam = cam
+        self.slug = slug
+        self.kind = kind
+        self.others_watching = False
+        self._go2rtc_port = go2rtc_port
+        self._connects = deque()
+        self._response = None
+        self._stop = Event()
+        self._thread = None
+
+    def _budget_wait(self) -> float:
+        now = time.time()
+        while self._connects and now - self._connects[0] > 3600:
+            self._connects.popleft()
+        if len(self._connects) < const.WARM_CONNECTS_PER_HOUR:
+            return 0
+        return self._connects[0] + 3600 - now
+
+    def _hold(self) -> None:
+        self._response = go2rtc.open_stream(self._go2rtc_port, self.slug)
+        started = time.monotonic()
+        with self._response:
+            for _ in self._response.iter_content(chunk_size=65536):
+                if self._stop.is_set():
+                    return
+                if time.monotonic() - started > const.WARM_RENEW_INTERVAL and not self.others_watching:
+                    log.debug(f"Renewing {self.kind} stream for camera {self.cam.name}")
+                    return
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            wait = self._budget_wait()
+            if wait:
+                log.warning(f"Camera {self.cam.name} has reconnected {const.WARM_CONNECTS_PER_HOUR} times in the "
+                            f"last hour, pausing its {self.kind} stream for {wait / 60:.0f} minutes")
+                self._stop.wait(wait)
+                continue
+            self._connects.append(time.time())
+            metrics.WARM_CONNECTS_TOTAL.inc()
+            # stop() closes the response under the reader, which urllib3 can report as an AttributeError
+            try:
+                self._hold()
+            except (requests.RequestException, OSError, AttributeError) as exc:
+                if not self._stop.is_set():
+                    log.warning(f"{self.kind.capitalize()} stream for camera {self.cam.name} dropped: {exc}")
+                    self._stop.wait(const.WARM_RETRY_DELAY)
+
+    def start(self) -> None:
+        log.info(f"Keeping camera {self.cam.name} connected ({self.kind})")
+        self._thread = Thread(target=self._run, name=f"warm-{self.slug}", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        if self._response is not None:
+            self._response.close()
+
+
+class WarmStreams:
+    """
+    Keeps streams connected in go2rtc for cameras that should open instantly: the cameras the user
+    picked, or else the ones Abode says can stream around the clock. At most `max_streams` are
+    kept warm at once, and a camera nobody has watched for `idle_timeout` seconds is let go until
+    someone opens it again.
+    """
+    def __init__(self, go2rtc_port: int, cameras: CameraRegistry, selected: List[str] = None,
+                 max_streams: int = const.WARM_MAX_STREAMS, idle_timeout: float = const.WARM_IDLE_TIMEOUT) -> None:
+        self._go2rtc_port = go2rtc_port
+        self._cameras = cameras
+        self._selected = selected or list()
+        self._max_streams = max_streams
+        self._idle_timeout = idle_timeout
+        self._keepers: Dict[str, StreamKeeper] = dict()
+        self._last_watched: Dict[str, float] = dict()
+        self._lock = Lock()
+        self._stop = Event()
+
+    def _candidates(self) -> List[Camera]:
+        if self._selected:
+            cams = [self._cameras.get(key) for key in self._selected]
+            missing = [key for key, cam in zip(self._selected, cams) if cam is None]
+            if missing:
+                log.warning(f"Always-on cameras not found in Abode: {', '.join(missing)}")
+            return [cam for cam in cams if cam]
+        return sorted((cam for cam in self._cameras if cam.can_stream_247), key=lambda cam: cam.name)
+
+    def _start_keeper(self, cam: Camera) -> bool:
+        slug = self._cameras.slugs.get(cam.id)
+        if not slug or len(self._keepers) >= self._max_streams:
+            return False
+        keeper = self._keepers[cam.id] = StreamKeeper(self._go2rtc_port, cam, slug)
+        keeper.start()
+        metrics.WARM_STREAMS.set(len(self._keepers))
+        return True
+
+    def _stop_keeper(self, cam_id: str, reason: str) -> None:
+        keeper = self._keepers.pop(cam_id, None)
+        if keeper:
+            log.info(f"Letting camera {keeper.cam.name} go cold ({reason})")
+            keeper.stop()
+            metrics.WARM_STREAMS.set(len(self._keepers))
+
+    def touch(self, cam_id: str) -> None:
+        """
+        Notes that someone opened a camera, warming it back up if it is eligible and there is room.
+        """
+        with self._lock:
+            # While a camera is being kept warm go2rtc only asks for it when our own connection
+            # (re)starts it; viewers of warm cameras are spotted by check() instead
+            if cam_id in self._keepers or self._stop.is_set():
+                return
+            self._last_watched[cam_id] = time.time()
+            cam = next((c for c in self._candidates() if c.id == cam_id), None)
+            if cam:
+                self._start_keeper(cam)
+
+    def update(self) -> None:
+        """
+        Brings the warm streams in line with the camera list after cameras are added, removed
+        or renamed.
+        """
+        with self._lock:
+            candidates = {cam.id: cam for cam in self._candidates()}
+            slugs = self._cameras.slugs
+            for cam_id, keeper in list(self._keepers.items()):
+                if cam_id not in candidates:
+                    self._stop_keeper(cam_id, "no longer selected")
+                elif slugs.get(cam_id) != keeper.slug:
+                    self._stop_keeper(cam_id, "renamed")
+                    self._start_keeper(candidates[cam_id])
+
+    def check(self) -> None:
+        try:
+            streams = go2rtc.get_streams(self._go2rtc_port) or dict()
+        except requests.RequestException as exc:
+            log.debug(f"Unable to get stream list from go2rtc: {exc}")
+            return
+        now = time.time()
+        with self._lock:
+            for cam_id, keeper in list(self._keepers.items()):
+                consumers = (streams.get(keeper.slug) or dict()).get('consumers') or list()
+                keeper.others_watching = len(consumers) > 1
+                if keeper.others_watching:
+                    self._last_watched[cam_id] = now
+                elif self._idle_timeout and now - self._last_watched.get(cam_id, now) > self._idle_timeout:
+                    self._stop_keeper(cam_id, f"not watched for {self._idle_timeout / 60:.0f} minutes")
+
+    def _run(self) -> None:
+        while not self._stop.wait(const.WARM_CHECK_INTERVAL):
+            self.check()
+
+    def start(self) -> None:
+        now = time.time()
+        with self._lock:
+            for cam in self._candidates():
+                self._last_watched.setdefault(cam.id, now)
+                self._start_keeper(cam)
+        Thread(target=self._run, name='warm-streams', daemon=True).start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        with self._lock:
+            for cam_id in list(self._keepers):
+                self._stop_keeper(cam_id, "shutting down")
@@ -0,0 +1,325 @@
+import base64
+import hashlib
+import json
+import random
+import struct
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Lock, Thread
+from typing import Optional
+from urllib.parse import urlparse
+
+_WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+
+@dataclass
+class Faults:
+    """
+    Latency and error injection for the mock servers. Every response is delayed by `latency`
+    seconds plus up to `jitter` more, and fails with a 500 with probability `error_rate`.
+    """
+    latency: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    offline: set = field(default_factory=set)
+
+    def apply(self) -> bool:
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay:
+            time.sleep(delay)
+        return random.random() < self.error_rate
+
+
+def _jwt(claims: dict) -> str:
+    def encode(data: dict) -> str:
+        return base64.urlsafe_b64encode(json.dumps(data).encode()).decode().rstrip('=')
+    return f"{encode({'alg': 'none'})}.{encode(claims)}.sig"
+
+
+def make_cameras(count: int) -> list:
+    return [{
+        'id': f"XF:{i:012x}",
+        'uuid': f"{i:032x}",
+        'name': f"Camera {i}",
+        'type_tag': 'device_type.mini_cam',
+        'origin': 'abode_cam',
+        'canStream247': i % 2 == 0
+    } for i in range(1, count + 1)]
+
+
+class _MockWebSocket:
+    """
+    Just enough of a WebSocket server connection for the mocks: unfragmented text frames out,
+    masked frames in.
+    """
+    def __init__(self, handler: BaseHTTPRequestHandler) -> None:
+        self._rfile = handler.rfile
+        self._wfile = handler.wfile
+        self._lock = Lock()
+        self.closed = False
+
+    def send(self, text: str) -> None:
+        payload = text.encode()
+        if len(payload) < 126:
+            header = struct.pack('!BB', 0x81, len(payload))
+        elif len(payload) < 65536:
+            header = struct.pack('!BBH', 0x81, 126, len(payload))
+        else:
+            header = struct.pack('!BBQ', 0x81, 127, len(payload))
+        with self._lock:
+            self._wfile.write(header + payload)
+            self._wfile.flush()
+
+    def recv(self) -> Optional[str]:
+        """
+        Returns the next text message, or None once the client has gone away.
+        """
+        while True:
+            head = self._rfile.read(2)
+            if len(head) < 2:
+                self.closed = True
+                return None
+            opcode, length = head[0] & 0x0f, head[1] & 0x7f
+            if length == 126:
+                length = struct.unpack('!H', self._rfile.read(2))[0]
+            elif length == 127:
+                length = struct.unpack('!Q', self._rfile.read(8))[0]
+            mask = self._rfile.read(4) if head[1] & 0x80 else bytes(4)
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(self._rfile.read(length)))
+            if opcode == 0x8:
+                self.closed = True
+                return None
+            if opcode == 0x1:
+                return payload.decode()
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    server: '_MockServer'
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args) -> None:
+        pass
+
+    def _reply(self, status: int, data) -> None:
+        payload = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _handle(self, method: str) -> None:
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        path = urlparse(self.path).path
+        self.server.calls[f"{method} {path}"] = self.server.calls.get(f"{method} {path}", 0) + 1
+        if self.server.faults.apply():
+            self._reply(500, {'message': 'injected failure'})
+            return
+        route = self.server.route(method, path, self.headers)
+        if route is None:
+            self._reply(404, {'message': f"no mock for {method} {path}"})
+        else:
+            self._reply(*route)
+
+    def _accept_websocket(self) -> _MockWebSocket:
+        accept = hashlib.sha1((self.headers['Sec-WebSocket-Key'] + _WEBSOCKET_GUID).encode()).digest()
+        self.send_response(101, 'Switching Protocols')
+        self.send_header('Upgrade', 'websocket')
+        self.send_header('Connection', 'Upgrade')
+        self.send_header('Sec-WebSocket-Accept', base64.b64encode(accept).decode())
+        self.end_headers()
+        self.close_connection = True
+        return _MockWebSocket(self)
+
+    def do_GET(self) -> None:
+        if self.headers.get('Upgrade', '').lower() == 'websocket':
+            path = urlparse(self.path).path
+            route = self.server.websocket_route(path)
+            if route is None:
+                self._reply(404, {'message': f"no mock WebSocket for {path}"})
+            else:
+                route(self._accept_websocket())
+            return
+        self._handle('GET')
+
+    def do_POST(self) -> None:
+        self._handle('POST')
+
+
+class _MockServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, faults: Faults = None) -> None:
+        self.faults = faults or Faults()
+        self.calls = dict()
+        super().__init__(('127.0.0.1', 0), _MockHandler)
+
+    def handle_error(self, request, client_address) -> None:
+        # Clients going away mid-request are expected when a benchmark kills spawn.py
+        pass
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def route(self, method: str, path: str, headers) -> tuple:
+        raise NotImplementedError
+
+    def websocket_route(self, path: str):
+        return None
+
+    def start(self) -> '_MockServer':
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+class MockAbode(_MockServer):
+    """
+    Stands in for my.goabode.com: login, claims, devices, features and KVS stream setup, plus
+    the Socket.IO event feed. Call `push_event` to send an event to everyone listening.
+    """
+    def __init__(self, cameras: list, faults: Faults = None, token_ttl: int = 3600) -> None:
+        super().__init__(faults)
+        self.cameras = cameras
+        self.token_ttl = token_ttl
+        self._event_sockets = list()
+
+    def _devices(self) -> list:
+        return [dict(c, faults={'no_response': int(c['id'] in self.faults.offline)}) for c in self.cameras]
+
+    def _event_feed(self, ws: _MockWebSocket) -> None:
+        ws.send('0' + json.dumps({'sid': 'mock', 'upgrades': [], 'pingInterval': 25000, 'pingTimeout': 5000}))
+        ws.send('40')
+        self._event_sockets.append(ws)
+        try:
+            while True:
+                message = ws.recv()
+                if message is None:
+                    return
+                if message == '2':
+                    ws.send('3')
+        finally:
+            self._event_sockets.remove(ws)
+
+    def websocket_route(self, path: str):
+        return self._event_feed if path == '/socket.io/' else None
+
+    def push_event(self, event: str, data) -> int:
+        """
+        Sends an event to every connected event feed, and returns how many there were.
+        """
+        message = '42' + json.dumps([event, data])
+        for ws in list(self._event_sockets):
+            try:
+                ws.send(message)
+            except OSError:
+                pass
+        return len(self._event_sockets)
+
+    def _kvs_stream(self, cam_uuid: str) -> tuple:
+        cam = next((c for c in self.cameras if c['uuid'] == cam_uuid), None)
+        if cam is None:
+            return 404, {'errorCode': 404, 'message': 'Camera not found'}
+        if cam['id'] in self.faults.offline:
+            return 200, {'errorCode': 2604, 'message': 'Camera is offline'}
+        signed_at = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime())
+        arn = f"arn:aws:kinesisvideo:us-west-2:123456789012:channel/{cam_uuid}/{int(time.time() * 1000)}"
+        return 200, {
+            'channelEndpoint': f"wss://v-mock.kinesisvideo.us-west-2.amazonaws.com/?X-Amz-ChannelARN={arn}"
+                               f"&X-Amz-Date={signed_at}&X-Amz-Expires=300&X-Amz-Signature=mock",
+            'iceServers': [{'urls': ['stun:stun.kinesisvideo.us-west-2.amazonaws.com:443']},
+                           {'urls': ['turn:mock:443'], 'username': 'u', 'credential': 'c', 'ttl': 300}],
+            'type': 'KVS'
+        }
+
+    def route(self, method: str, path: str, headers) -> tuple:
+        if method == 'POST' and path == '/api/auth2/login':
+            return 200, {'token': 'mock-api-key'}
+        if method == 'GET' and path == '/api/auth2/claims':
+            return 200, {'access_token': _jwt({'exp': int(time.time()) + self.token_ttl})}
+        if method == 'GET' and path == '/api/v1/devices':
+            return 200, self._devices()
+        if method == 'GET' and path == '/integrations/v1/features':
+            return 200, {'cameras': True}
+        if method == 'POST' and path.startswith('/integrations/v1/camera/') and path.endswith('/kvs/stream'):
+            return self._kvs_stream(path.split('/')[4])
+        return None
+
+
+class MockSupervisor(_MockServer):
+    """
+    Stands in for the Home Assistant Supervisor: core config and states, the entity and device
+    registries over the WebSocket API, and the add-on's own info.
+    """
+    def __init__(self, cameras: list, faults: Faults = None, extra_entities: int = 0, ports: dict = None) -> None:
+        super().__init__(faults)
+        self.cameras = cameras
+        self.extra_entities = extra_entities
+        self.ports = ports or dict()
+
+    def _states(self) -> list:
+        states = [{
+            'entity_id': f"camera.{c['name'].lower().replace(' ', '_')}_ha",
+            'state': 'idle',
+            'attributes': {'device_id': c['id'], 'device_type': 'Abode Cam 2'}
+        } for c in self.cameras]
+        states += [{'entity_id': f"sensor.filler_{i}", 'state': '0', 'attributes': {}}
+                   for i in range(self.extra_entities)]
+        return states
+
+    def _entity_registry(self) -> list:
+        entities = [{'entity_id': f"camera.{c['name'].lower().replace(' ', '_')}_ha", 'platform': 'abode',
+                     'device_id': f"ha-{c['uuid']}"} for c in self.cameras]
+        entities += [{'entity_id': f"sensor.filler_{i}", 'platform': 'mock', 'device_id': None}
+                     for i in range(self.extra_entities)]
+        return entities
+
+    def _device_registry(self) -> list:
+        return [{'id': f"ha-{c['uuid']}", 'identifiers': [['abode', c['id']]]} for c in self.cameras]
+
+    def _ws_command(self, message: dict):
+        if message.get('type') == 'config/entity_registry/list':
+            return self._entity_registry()
+        if message.get('type') == 'config/device_registry/list':
+            return self._device_registry()
+        if message.get('type') == 'config/entity_registry/get':
+            return next((e for e in self._entity_registry() if e['entity_id'] == message.get('entity_id')), None)
+        if message.get('type') in ('subscribe_events', 'subscribe_trigger'):
+            return None
+        raise KeyError(message.get('type'))
+
+    def _websocket(self, ws: _MockWebSocket) -> None:
+        ws.send(json.dumps({'type': 'auth_required', 'ha_version': 'mock'}))
+        auth = json.loads(ws.recv() or '{}')
+        if auth.get('type') != 'auth':
+            return
+        ws.send(json.dumps({'type': 'auth_ok', 'ha_version': 'mock'}))
+        while True:
+            text = ws.recv()
+            if text is None:
+                return
+            message = json.loads(text)
+            self.calls[f"WS {message.get('type')}"] = self.calls.get(f"WS {message.get('type')}", 0) + 1
+            try:
+                reply = {'success': True, 'result': self._ws_command(message)}
+            except KeyError:
+                reply = {'success': False, 'error': {'code': 'unknown_command', 'message': 'Unknown command.'}}
+            ws.send(json.dumps(dict(reply, id=message.get('id'), type='result')))
+
+    def websocket_route(self, path: str):
+        return self._websocket if path == '/core/websocket' else None
+
+    def route(self, method: str, path: str, headers) -> tuple:
+        if method == 'GET' and path == '/core/api/config':
+            return 200, {'components': ['abode', 'camera']}
+        if method == 'GET' and path == '/core/api/states':
+            return 200, self._states()
+        if method == 'GET' and path == '/addons/self/info':
+            network = {f"{internal}/tcp": self.ports[name]
+                       for name, internal in (('go2rtc', 1984), ('rtsp', 8554), ('webrtc', 8555), ('api', 80))
+                       if name in self.ports}
+            return 200, {'data': {'network': network}}
+        return None
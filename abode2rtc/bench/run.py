@@ -0,0 +1,299 @@
+#! /usr/bin/env python3
+"""
+Offline benchmarks for abode2rtc. Everything runs against local stand-ins for the Abode cloud,
+the Supervisor and go2rtc (see mock_servers.py and fakebin/go2rtc), so results don't depend on
+the network and can be compared across releases.
+
+    python3 bench/run.py --cameras 1 10 50 --viewers 6 --output bench.json
+"""
+import argparse
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), 'abode2rtc')
+FAKEBIN_DIR = os.path.join(BENCH_DIR, 'fakebin')
+
+sys.path.insert(0, SRC_DIR)
+from mock_servers import Faults, MockAbode, MockSupervisor, make_cameras  # noqa: E402
+
+
+def percentiles(samples: list) -> dict:
+    ordered = sorted(samples)
+
+    def rank(p: float) -> float:
+        return ordered[min(len(ordered) - 1, max(0, int(round(p / 100 * len(ordered) + 0.5)) - 1))]
+    return {
+        'samples': len(ordered),
+        'mean': sum(ordered) / len(ordered),
+        'p50': rank(50),
+        'p95': rank(95),
+        'p99': rank(99),
+    }
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def _get_json(url: str):
+    with urllib.request.urlopen(url, timeout=1) as response:
+        return json.load(response)
+
+
+def _fetch(url: str) -> float:
+    start = time.monotonic()
+    try:
+        with urllib.request.urlopen(url, timeout=30) as response:
+            response.read()
+    except urllib.error.HTTPError:
+        pass
+    return time.monotonic() - start
+
+
+class Environment:
+    """
+    A throwaway data/temp directory plus the mock servers, and the environment spawn.py and
+    stream.py need in order to use them.
+    """
+    def __init__(self, cameras: int, faults: Faults) -> None:
+        self.dir = tempfile.mkdtemp(prefix='abode2rtc-bench-')
+        self.cameras = make_cameras(cameras)
+        self.ports = {name: free_port() for name in ('go2rtc', 'rtsp', 'webrtc', 'api')}
+        self.abode = MockAbode(self.cameras, faults).start()
+        self.supervisor = MockSupervisor(self.cameras, faults, ports=self.ports).start()
+        self.options_path = os.path.join(self.dir, 'options.json')
+        with open(self.options_path, 'w') as f:
+            json.dump({'abode_username': 'bench@example.com', 'abode_password': 'bench',
+                       'locale': 'en-US', 'debug': False}, f)
+
+    @property
+    def env(self) -> dict:
+        env = dict(os.environ)
+        env.update({
+            'ABODE_BASE_URL': self.abode.url,
+            'ABODE2RTC_DATA_DIR': self.dir,
+            'TMPDIR': self.dir,
+            'SUPERVISOR_TOKEN': 'bench',
+            'PATH': FAKEBIN_DIR + os.pathsep + env.get('PATH', ''),
+        })
+        return env
+
+    def reset_state(self) -> None:
+        for name in os.listdir(self.dir):
+            if name != 'options.json':
+                path = os.path.join(self.dir, name)
+                shutil.rmtree(path) if os.path.isdir(path) else os.unlink(path)
+
+    def close(self) -> None:
+        self.abode.shutdown()
+        self.supervisor.shutdown()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+
+def bench_startup(env: Environment, warm: bool, runs: int, timeout: float = 60) -> list:
+    """
+    Time from launching spawn.py until go2rtc is serving every camera.
+    """
+    samples = list()
+    streams_url = f"http://127.0.0.1:{env.ports['go2rtc']}/api/streams"
+    if warm:
+        env.reset_state()
+        bench_startup(env, warm=False, runs=1)
+    for _ in range(runs):
+        if not warm:
+            env.reset_state()
+        start = time.monotonic()
+        proc = subprocess.Popen([sys.executable, os.path.join(SRC_DIR, 'spawn.py'), '-c', env.options_path,
+                                 '--supervisor-url', env.supervisor.url],
+                                env=env.env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                start_new_session=True)
+        try:
+            while time.monotonic() - start < timeout:
+                try:
+                    if len(_get_json(streams_url) or dict()) >= len(env.cameras):
+                        samples.append(time.monotonic() - start)
+                        break
+                except (OSError, ValueError):
+                    pass
+                time.sleep(0.01)
+            else:
+                raise TimeoutError(f"spawn.py didn't publish {len(env.cameras)} cameras within {timeout} seconds")
+        finally:
+            os.killpg(proc.pid, signal.SIGTERM)
+            proc.wait()
+    return samples
+
+
+def bench_resolver(env: Environment, viewers: int, rounds: int) -> dict:
+    """
+    Resolution through the resolver service: every camera opened by `viewers` viewers at once,
+    first with nothing cached and then again with the caches warm.
+    """
+    import const
+    from abode import AbodeApiClient
+    from resolver import ResolverServer, StreamResolver
+
+    const.BASE_URL = env.abode.url
+    const.DATA_DIR = env.dir
+    saved_tempdir = tempfile.tempdir
+    tempfile.tempdir = env.dir
+    try:
+        abode = AbodeApiClient('bench@example.com', 'bench')
+        abode.save()
+        server = ResolverServer(StreamResolver(abode), port=0)
+    finally:
+        tempfile.tempdir = saved_tempdir
+    server.start()
+    base = f"http://127.0.0.1:{server.server_address[1]}/stream/"
+    urls = [base + urllib.request.quote(c['id'], safe='') for c in env.cameras for _ in range(viewers)]
+    results = dict()
+    try:
+        with ThreadPoolExecutor(max_workers=len(env.cameras) * viewers) as pool:
+            results['cold'] = list(pool.map(_fetch, urls))
+            results['warm'] = list()
+            for _ in range(rounds):
+                results['warm'] += list(pool.map(_fetch, urls))
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def bench_stream_py(env: Environment, viewers: int) -> list:
+    """
+    Resolution by running stream.py once per viewer, the way go2rtc used to.
+    """
+    state_path = os.path.join(env.dir, 'abode.json')
+
+    def run(cam_id: str) -> float:
+        start = time.monotonic()
+        subprocess.run([sys.executable, os.path.join(SRC_DIR, 'stream.py'), state_path, cam_id],
+                       env=env.env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return time.monotonic() - start
+
+    cam_ids = [c['id'] for c in env.cameras for _ in range(viewers)]
+    with ThreadPoolExecutor(max_workers=len(cam_ids)) as pool:
+        return list(pool.map(run, cam_ids))
+
+
+def bench_logs(lines: int, runs: int) -> list:
+    """
+    Throughput of the go2rtc log pump, in lines per second, with go2rtc's usual mix of trace,
+    debug and info records and the log level at info. Each run lasts until every record has been
+    formatted and written (to /dev/null), and the log queue is unbounded meanwhile so that none
+    are dropped.
+    """
+    from queue import Queue
+
+    import go2rtc
+    import logger
+
+    mix = [b"12:00:00.000 TRC [webrtc] candidate=host 192.168.1.10:8555 udp\n",
+           b"12:00:00.001 DBG [streams] start producer url=webrtc:wss://example\n",
+           b"\x1b[32m12:00:00.002 INF [api] request path=/api/streams\x1b[0m\n",
+           b"12:00:00.003 TRC [webrtc] ice state=checking\n   continued on the next line\n"]
+    path = os.path.join(tempfile.mkdtemp(prefix='abode2rtc-bench-'), 'go2rtc.log')
+    with open(path, 'wb') as f:
+        for i in range(lines):
+            f.write(mix[i % len(mix)])
+    # Stopping the listener waits for it to write out everything already queued
+    logger.listener.stop()
+    bounded = logger.queue_handler.queue
+    logger.queue_handler.queue = logger.listener.queue = Queue()
+    logger.handler.setStream(open(os.devnull, 'w'))
+    samples = list()
+    try:
+        for _ in range(runs):
+            logger.listener.start()
+            proc = subprocess.Popen(['cat', path], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            start = time.monotonic()
+            try:
+                go2rtc.pump_go2rtc_logs(proc)
+            finally:
+                logger.listener.stop()
+            samples.append(lines / (time.monotonic() - start))
+    finally:
+        logger.queue_handler.queue = logger.listener.queue = bounded
+        logger.handler.setStream(sys.stderr)
+        logger.listener.start()
+        shutil.rmtree(os.path.dirname(path), ignore_errors=True)
+    return samples
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description='Offline benchmarks for abode2rtc')
+    parser.add_argument('--cameras', type=int, nargs='+', default=[1, 10, 50],
+                        help='Camera counts to benchmark (default: %(default)s)')
+    parser.add_argument('--viewers', type=int, default=6,
+                        help='Concurrent viewers per camera (default: %(default)s)')
+    parser.add_argument('--runs', type=int, default=5,
+                        help='Repetitions of each startup and log benchmark (default: %(default)s)')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Simulated latency of each mock API call, in seconds (default: %(default)s)')
+    parser.add_argument('--jitter', type=float, default=0.0,
+                        help='Extra random latency of each mock API call, in seconds (default: %(default)s)')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of mock API calls that fail with a 500 (default: %(default)s)')
+    parser.add_argument('--log-lines', type=int, default=100000,
+                        help='Lines of go2rtc output for the log benchmark (default: %(default)s)')
+    parser.add_argument('--skip', nargs='*', default=[], choices=['startup', 'resolver', 'stream.py', 'logs'],
+                        help='Benchmarks to leave out')
+    parser.add_argument('--output', '-o', help='Write results as JSON to this file instead of stdout')
+    args = parser.parse_args()
+
+    faults = Faults(latency=args.latency, jitter=args.jitter, error_rate=args.error_rate)
+    results = list()
+
+    def record(benchmark: str, samples: list, unit: str = 'seconds', **params) -> None:
+        results.append(dict(benchmark=benchmark, unit=unit, **params, **percentiles(samples)))
+        print(f"{benchmark} {params}: p50={results[-1]['p50']:.4f} p95={results[-1]['p95']:.4f} "
+              f"p99={results[-1]['p99']:.4f} {unit}", file=sys.stderr)
+
+    for count in args.cameras:
+        env = Environment(count, faults)
+        try:
+            if 'startup' not in args.skip:
+                record('startup_cold', bench_startup(env, warm=False, runs=args.runs), cameras=count)
+                record('startup_warm', bench_startup(env, warm=True, runs=args.runs), cameras=count)
+            if 'resolver' not in args.skip:
+                env.reset_state()
+                resolved = bench_resolver(env, args.viewers, rounds=args.runs)
+                record('resolve_cold', resolved['cold'], cameras=count, viewers=args.viewers)
+                record('resolve_warm', resolved['warm'], cameras=count, viewers=args.viewers)
+            if 'stream.py' not in args.skip:
+                record('resolve_stream_py', bench_stream_py(env, args.viewers), cameras=count, viewers=args.viewers)
+        finally:
+            env.close()
+
+    if 'logs' not in args.skip:
+        record('go2rtc_log_pump', bench_logs(args.log_lines, args.runs), unit='lines/second', lines=args.log_lines)
+
+    report = {
+        'version': 1,
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'python': sys.version.split()[0],
+        'settings': {k: v for k, v in vars(args).items() if k != 'output'},
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main()